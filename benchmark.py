@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# write a synthetic reference genome with N runs and soft-masked runs, return chromosome lengths
+def generate_genome(path, chroms, length, n_runs, n_length, mask, seed):
+    rng = np.random.default_rng(seed)
+    bases = np.frombuffer(b'ACGT', dtype=np.uint8)
+    lengths = {}
+    with open(path, 'wb') as fw:
+        for i in range(chroms):
+            n = int(length * rng.uniform(0.5, 1.5)) if chroms > 1 else length
+            seq = bases[rng.integers(0, 4, n)]
+            # soft-masked runs cover about mask of the chromosome
+            nmask = int(n * mask / 1000)
+            for start in rng.integers(0, max(n - 1000, 1), nmask):
+                seq[start:start+1000] |= 32
+            for start in rng.integers(0, max(n - n_length, 1), n_runs):
+                seq[start:start+n_length] = ord('N')
+            fw.write(f'>chr{i+1}\n'.encode())
+            fw.write(b'\n'.join(seq[j:j+60].tobytes() for j in range(0, n, 60)) + b'\n')
+            lengths[f'chr{i+1}'] = n
+    return lengths
+
+
+# write Ribose-Map style BED libraries, one rNMP of count 1 on each line
+def generate_beds(prefix, lengths, libs, depth, seed):
+    rng = np.random.default_rng(seed)
+    names = list(lengths)
+    sizes = np.array([lengths[x] for x in names])
+    paths = []
+    for i in range(libs):
+        chrom = rng.choice(len(names), depth, p=sizes / sizes.sum())
+        pos = rng.integers(1, sizes[chrom] + 1)
+        strand = np.where(rng.integers(0, 2, depth), '+', '-')
+        path = f'{prefix}{i+1}.bed'
+        with open(path, 'w') as fw:
+            for c, p, s in zip(chrom.tolist(), pos.tolist(), strand.tolist()):
+                fw.write(f'{names[c]}\t{p-1}\t{p}\t1\t0\t{s}\n')
+        paths.append(path)
+    return paths
+
+
+# run a command, return wall time and peak RSS of the process in MB
+def run_stage(cmd, cwd):
+    # stderr goes to a temporary file, a full pipe would block the stage while it is waited for
+    with tempfile.TemporaryFile() as fe:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.DEVNULL, stderr=fe)
+        _, status, usage = os.wait4(proc.pid, 0)
+        seconds = time.perf_counter() - start
+        fe.seek(0)
+        err = fe.read().decode(errors='replace')
+    if os.waitstatus_to_exitcode(status):
+        sys.exit(f'[ERROR] Benchmark stage failed: {" ".join(cmd)}\n{err}')
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    rss = usage.ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+    return seconds, rss
+
+
+# time the stages of count_rNMP.py in a fresh process
+def profile_rnmp(task):
+    genome, beds, threads = task
+    import resource
+    from rNMPUtils import get_ribo_position, get_ribo, get_ribo_parallel
+    times = {}
+    start = time.perf_counter()
+    frs = [open(x) for x in beds]
+    libs, ribos = get_ribo_position(frs, False)
+    times['get_ribo_position'] = time.perf_counter() - start
+    start = time.perf_counter()
+    sys.stdout = open(os.devnull, 'w')
+    if threads > 1:
+        get_ribo_parallel(ribos, libs, genome, True, True, True, [1], threads)
+    else:
+        get_ribo(ribos, libs, genome, True, True, True, [1])
+    sys.stdout = sys.__stdout__
+    times['get_ribo'] = time.perf_counter() - start
+    for fr in frs:
+        fr.close()
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return times, usage / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+# print changes of each stage against an earlier result
+def compare(old, new):
+    stages = {x['stage']:x for x in old['stages']}
+    print(f'{"stage":<20}{"old s":>10}{"new s":>10}{"speedup":>10}{"old MB":>10}{"new MB":>10}')
+    for x in new['stages']:
+        if x['stage'] in stages:
+            y = stages[x['stage']]
+            print(f'{x["stage"]:<20}{y["seconds"]:>10.3f}{x["seconds"]:>10.3f}{y["seconds"]/x["seconds"]:>10.2f}{y["peak_rss_mb"]:>10.1f}{x["peak_rss_mb"]:>10.1f}')
+
+
+def main():
+    # argparse
+    parser = argparse.ArgumentParser(description='Benchmark the analysis scripts on a synthetic genome and BED libraries')
+    parser.add_argument('-o', default='benchmark.json', help='Output JSON file of results, default = benchmark.json')
+    parser.add_argument('--workdir', help='Directory of generated data and outputs, kept after the run, default = temporary directory')
+    parser.add_argument('--chroms', type=int, default=4, help='Number of chromosomes, default = 4')
+    parser.add_argument('--length', type=int, default=5000000, help='Average chromosome length, default = 5000000')
+    parser.add_argument('--n_runs', type=int, default=10, help='Number of N runs per chromosome, default = 10')
+    parser.add_argument('--n_length', type=int, default=1000, help='Length of N runs, default = 1000')
+    parser.add_argument('--mask', type=float, default=0.1, help='Fraction of soft-masked (lowercase) bases, default = 0.1')
+    parser.add_argument('--libs', type=int, default=8, help='Number of BED libraries, default = 8')
+    parser.add_argument('--depth', type=int, default=200000, help='Number of rNMPs in each library, default = 200000')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of generated data, default = 0')
+    parser.add_argument('-p', '--threads', type=int, default=1, help='Number of processes passed to the scripts, default = 1')
+    parser.add_argument('--stages', nargs='+', choices=['count_background', 'count_rNMP', 'rNMP_functions', 'get_chrom', 'normalize', 'draw_heatmap'], help='Stages to run, default = all')
+    parser.add_argument('--compare', type=argparse.FileType('r'), help='Earlier JSON result to compare with')
+    args = parser.parse_args()
+
+    tmp = None
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        workdir = os.path.abspath(args.workdir)
+    else:
+        tmp = tempfile.TemporaryDirectory()
+        workdir = tmp.name
+    stages = args.stages or ['count_background', 'count_rNMP', 'rNMP_functions', 'get_chrom', 'normalize', 'draw_heatmap']
+
+    # synthetic data
+    genome = os.path.join(workdir, 'genome.fa')
+    lengths = generate_genome(genome, args.chroms, args.length, args.n_runs, args.n_length, args.mask, args.seed)
+    beds = generate_beds(os.path.join(workdir, 'lib'), lengths, args.libs, args.depth, args.seed + 1)
+    bases = sum(lengths.values())
+    ribos = args.libs * args.depth
+    print(f'Generated {len(lengths)} chromosomes of {bases} bases and {args.libs} libraries of {args.depth} rNMPs!')
+
+    # command, amount of work and throughput unit of each stage
+    py = sys.executable
+    script = lambda x: os.path.join(SCRIPT_DIR, x)
+    plan = {
+        'count_background': ([py, script('count_background.py'), genome, '-o', 'bg.tsv', '-p', str(args.threads), '--no_cache'], bases, 'bases/s'),
+        'count_rNMP': ([py, script('count_rNMP.py'), genome] + beds + ['-m', '-d', '-t', '-o', 'raw', '-p', str(args.threads)], ribos, 'rNMPs/s'),
+        'get_chrom': ([py, script('get_chrom.py')] + [f'raw_lib{i+1}.dinuc_d1_nr' for i in range(args.libs)] + ['-s', 'chr1', '-o', 'chr1.tsv'], args.libs * len(lengths), 'rows/s'),
+        'normalize': ([py, script('normalize.py'), 'chr1.tsv', 'bg.tsv', '--name', 'chr1', '--group_len', '4', '-o', 'chr1_norm.tsv'], args.libs, 'rows/s'),
+        'draw_heatmap': ([py, script('draw_heatmap.py'), 'chr1_norm.tsv', '-o', 'chr1_norm.png'], args.libs, 'rows/s'),
+    }
+    results = []
+    for stage in stages:
+        if stage == 'rNMP_functions':
+            sys.path.insert(0, SCRIPT_DIR)
+            with ProcessPoolExecutor(1) as pool:
+                times, rss = pool.submit(profile_rnmp, (genome, beds, args.threads)).result()
+            results.append({'stage':'get_ribo_position', 'seconds':times['get_ribo_position'], 'peak_rss_mb':rss, 'throughput':ribos / times['get_ribo_position'], 'unit':'rNMPs/s'})
+            results.append({'stage':'get_ribo', 'seconds':times['get_ribo'], 'peak_rss_mb':rss, 'throughput':bases / times['get_ribo'], 'unit':'bases/s'})
+        else:
+            cmd, amount, unit = plan[stage]
+            seconds, rss = run_stage(cmd, workdir)
+            results.append({'stage':stage, 'seconds':seconds, 'peak_rss_mb':rss, 'throughput':amount / seconds, 'unit':unit})
+        for x in results[-2 if stage == 'rNMP_functions' else -1:]:
+            print(f'{x["stage"]}: {x["seconds"]:.3f} s, {x["throughput"]:.4g} {x["unit"]}, peak RSS {x["peak_rss_mb"]:.1f} MB')
+
+    # output
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    report = {
+        'commit':commit,
+        'time':time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python':platform.python_version(),
+        'platform':platform.platform(),
+        'cpus':os.cpu_count(),
+        'params':{k:v for k, v in vars(args).items() if k not in ['o', 'compare', 'workdir']},
+        'genome':{'chromosomes':len(lengths), 'bases':bases},
+        'rNMPs':ribos,
+        'stages':results,
+    }
+    with open(args.o, 'w') as fw:
+        json.dump(report, fw, indent=2)
+    if args.compare:
+        compare(json.load(args.compare), report)
+    if tmp is not None:
+        tmp.cleanup()
+    print(f'Done!Results are saved to {args.o}!')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,94 +1,295 @@
 #!/usr/bin/env python3
 
-from collections import defaultdict
 import argparse
+import hashlib
+import json
+import os
 import sys
-import itertools as it
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+from genomeUtils import *
+from profileUtils import PROFILER, timed_call
+from rNMPUtils import generate_outputname
+
+
+# default cache directory of background tables
+CACHE_DIR = os.environ.get('RIBOSE_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'RibosePreferenceAnalysis'))
+
+
+# count kmers of each chromosome in one pass, bases of a kmer are taken at offsets
+# return {chrom: counts} of each offsets for chromosomes with at least one window
+def count_kmers(fasta, offsets_list, allow_dup_chroms=False):
+    span = max(max(x) for x in offsets_list)
+    data = [{} for _ in offsets_list]
+    seen = set()
+
+    # check duplicate chromosomes before reading them
+    def keep(chrom):
+        if chrom in seen and not allow_dup_chroms:
+            print('Skip duplicate chromosome {}!'.format(chrom))
+            return False
+        seen.add(chrom)
+        print('Start counting {}!'.format(chrom))
+        return True
+
+    cache = None
+    stat = None
+    for chrom, codes in iter_codes(fasta, keep):
+        # header
+        if codes is None:
+            record_chrom(stat)
+            stat = [chrom, time.perf_counter(), time.process_time(), 0]
+            cache = np.empty(0, dtype=np.uint8)
+            continue
+        if cache is None:
+            continue
+        stat[3] += len(codes)
+        # keep the tail of last block for kmers across blocks
+        codes = np.concatenate([cache, codes])
+        for offsets, v in zip(offsets_list, data):
+            # windows starting in the cache are counted in last block
+            counts, windows = count_codes(codes[max(len(cache) - max(offsets), 0):], offsets)
+            if windows:
+                v[chrom] = v[chrom] + counts if chrom in v else counts
+        cache = codes[len(codes) - span:] if len(codes) > span else codes
+    record_chrom(stat)
+    return data
+
+
+# record reading and counting of a chromosome, stat = [chrom, wall time, cpu time, bases]
+def record_chrom(stat):
+    if stat is not None:
+        PROFILER.record('count_chrom', time.perf_counter() - stat[1], time.process_time() - stat[2], chrom=stat[0], bases=stat[3])
+
+
+# count kmers with a process pool, long chromosomes are split to chunks
+# each chunk is read with the first bases of next chunk for kmers across chunks
+def count_kmers_parallel(fasta, offsets_list, threads, allow_dup_chroms=False, chunk_size=1<<24):
+    chroms = indexed_chroms(fasta)
+    if chroms is None:
+        print('[WARNING] Fasta file cannot be indexed, count with one process!', file=sys.stderr)
+        return count_kmers(fasta, offsets_list, allow_dup_chroms)
+    span = max(max(x) for x in offsets_list)
+    # split to tasks
+    tasks = []
+    seen = set()
+    for chrom, entry in chroms:
+        if chrom in seen and not allow_dup_chroms:
+            print('Skip duplicate chromosome {}!'.format(chrom))
+            continue
+        seen.add(chrom)
+        for start in range(0, entry[1], chunk_size):
+            tasks.append((chrom, fasta, entry, start, min(start + chunk_size, entry[1]), span, offsets_list))
+    # count and merge
+    data = [{} for _ in offsets_list]
+    with ProcessPoolExecutor(threads) as pool:
+        for task, (part, stats) in zip(tasks, pool.map(partial(timed_call, count_chunk), tasks)):
+            chrom = task[0]
+            PROFILER.record('count_chunk', chrom=chrom, start=task[3], end=task[4], bases=task[4] - task[3], **stats)
+            for v, (counts, windows) in zip(data, part):
+                if windows:
+                    v[chrom] = v[chrom] + counts if chrom in v else counts
+            if not task[3]:
+                print('Start counting {}!'.format(chrom))
+    return data
+
+
+# count kmers starting in [start, end) of a chromosome in a worker process
+def count_chunk(task):
+    _, fasta, entry, start, end, span, offsets_list = task
+    codes = fetch_codes(fasta, entry, start, min(end + span, entry[1]))
+    return [count_codes(codes[:end - start + max(offsets)], offsets) for offsets in offsets_list]
+
+
+# sha256 of fasta content, hashes are kept in cache with file size and mtime
+def fasta_hash(fasta, cache_dir):
+    path = os.path.realpath(fasta)
+    st = os.stat(path)
+    memo_file = os.path.join(cache_dir, 'hashes.json')
+    memo = {}
+    try:
+        with open(memo_file) as fr:
+            memo = json.load(fr)
+    except (OSError, ValueError):
+        pass
+    if path in memo and memo[path][:2] == [st.st_size, st.st_mtime_ns]:
+        return memo[path][2]
+    h = hashlib.sha256()
+    with open(path, 'rb') as fr:
+        for block in iter(lambda: fr.read(1<<24), b''):
+            h.update(block)
+    memo[path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+    try:
+        save_atomic(memo_file, lambda fw: json.dump(memo, fw))
+    except OSError:
+        print(f'[WARNING] Cannot write {memo_file}, hash of fasta is not cached!', file=sys.stderr)
+    return memo[path][2]
+
+
+# write a file through a temporary file, so readers never see partial files
+def save_atomic(path, write, mode='w'):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as fw:
+            write(fw)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+# remove least recently used tables until the cache is smaller than size_limit bytes
+def evict_cache(cache_dir, size_limit):
+    files = [os.path.join(cache_dir, x) for x in os.listdir(cache_dir) if x.endswith('.npz')]
+    files.sort(key=os.path.getmtime)
+    total = sum(os.path.getsize(x) for x in files)
+    for f in files:
+        if total <= size_limit:
+            break
+        total -= os.path.getsize(f)
+        os.remove(f)
+
+
+# background counts of each offsets, tables are loaded from or saved to cache if cache_dir is set
+# cache key is fasta content, offsets and allow_dup_chroms, both strands are made from the same table
+def get_background(fasta, offsets_list, threads=1, allow_dup_chroms=False, cache_dir=None, cache_size=1<<30):
+    if fasta == '-' or not cache_dir:
+        if threads > 1:
+            return count_kmers_parallel(fasta, offsets_list, threads, allow_dup_chroms)
+        return count_kmers(fasta, offsets_list, allow_dup_chroms)
+    # the cache is optional, count without it if the directory cannot be used
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError:
+        print(f'[WARNING] Cannot create cache directory {cache_dir}, count without cache!', file=sys.stderr)
+        return get_background(fasta, offsets_list, threads, allow_dup_chroms)
+    key = fasta_hash(fasta, cache_dir)
+    files = [os.path.join(cache_dir, f'{key}_{"-".join(map(str, x))}_{int(allow_dup_chroms)}.npz') for x in offsets_list]
+    # load cached tables, mtime is used to track usage
+    results = [None] * len(offsets_list)
+    for i, f in enumerate(files):
+        if os.path.isfile(f):
+            with np.load(f) as data:
+                results[i] = dict(zip(data['chroms'].tolist(), data['counts']))
+            # a shared cache may be read-only
+            try:
+                os.utime(f)
+            except OSError:
+                pass
+            print(f'Load background of offsets {offsets_list[i]} from cache!')
+    # count the others in one pass
+    missing = [i for i, x in enumerate(results) if x is None]
+    if missing:
+        counted = get_background(fasta, [offsets_list[i] for i in missing], threads, allow_dup_chroms)
+        for i, result in zip(missing, counted):
+            results[i] = result
+            chroms = list(result.keys())
+            counts = np.array([result[x] for x in chroms]).reshape(len(chroms), 4**len(offsets_list[i]))
+            try:
+                save_atomic(files[i], lambda fw: np.savez(fw, chroms=np.array(chroms, dtype=str), counts=counts), 'wb')
+            except OSError:
+                print(f'[WARNING] Cannot write {files[i]}, background of offsets {offsets_list[i]} is not cached!', file=sys.stderr)
+    try:
+        evict_cache(cache_dir, cache_size)
+    except OSError:
+        print(f'[WARNING] Cannot remove old tables from cache directory {cache_dir}!', file=sys.stderr)
+    return results
+
+
+# add opposite strand and write dinucleotide backgrounds of each distance to an npz file
+# counts: array of (chromosome, distance, dinucleotide), chromosomes are sorted like write_table
+def write_profile(path, results, dists, single_strand):
+    crs = sorted(set().union(*results))
+    counts = np.zeros((len(crs), len(dists), 16), dtype=np.int64)
+    for j, result in enumerate(results):
+        for i, chrom in enumerate(crs):
+            if chrom in result:
+                counts[i, j] = result[chrom]
+    if not single_strand:
+        counts = counts + counts[..., rc_index(2)]
+    np.savez(path, counts=counts, chromosomes=np.array(crs, dtype=str), distances=np.array(dists), dinucleotides=np.array(kmer_list(2), dtype=str))
+
+
+# add opposite strand and write background table
+def write_table(fw, result, k, single_strand):
+    if not single_strand:
+        rci = rc_index(k)
+        result = {chrom: v + v[rci] for chrom, v in result.items()}
+    fw.write('Sample\t' + '\t'.join(kmer_list(k)) + '\n')
+    for chrom in sorted(result.keys()):
+        fw.write(f'{chrom}\t' + '\t'.join(map(str, result[chrom].tolist())) + '\n')
 
-# reversecomplement
-def rc(s):
-    c = {'A':'T', 'C':'G', 'G':'C', 'T':'A'}
-    r = ''
-    for i in s:
-        r = c[i] + r
-    return r
 
 def main():
     # argument parser
     parser = argparse.ArgumentParser(description='Count dinucleotides from fasta file')
-    parser.add_argument('FASTA', type=argparse.FileType('r'), default=sys.stdin, help='Input fasta file to count')
+    parser.add_argument('FASTA', help='Input fasta file to count, plain or gzip/bgzip compressed, a fasta index (.fai) is used or created for plain fasta, \'-\' for stdin')
     parser.add_argument('-d', type=int, default=1, help='Distance between dinucleotide pair, default=1')
-    parser.add_argument('-o', type=argparse.FileType('w'), default=sys.stdout, help='Output to file')
+    parser.add_argument('--dist', type=int, nargs='+', help='Distances between dinucleotide pairs, count all of them in one pass')
+    parser.add_argument('-o', type=output_file, default='-', help='Output to file, default = stdout (\'-\'). Output basename if several tables are counted')
     parser.add_argument('-s', action='store_true', help='Count only one strand')
-    parser.add_argument('--mono', action='store_true', help='Count mono nucleotide instead')
-    parser.add_argument('--trinuc', action='store_true', help='Count trinucleotide instead')
+    parser.add_argument('--mono', action='store_true', help='Count mono nucleotide')
+    parser.add_argument('--dinuc', action='store_true', help='Count dinucleotide, default if no other mode is selected')
+    parser.add_argument('--trinuc', action='store_true', help='Count trinucleotide')
+    parser.add_argument('--kmer', type=int, nargs='+', help='Count kmers of these lengths, tables are named .k<KMER>')
+    parser.add_argument('--dist_range', type=int, nargs=2, metavar=('MIN', 'MAX'), help='Count dinucleotides of all distances from MIN to MAX in the same pass, saved as one array of (chromosome, distance, dinucleotide) to <basename>_<genome>.dist_profile.npz')
+    parser.add_argument('-p', '--threads', type=int, default=1, help='Number of processes, long chromosomes are split to chunks, default=1')
     parser.add_argument('--allow_dup_chroms', action='store_true', help='Sum up all counts of chromosomes with the same name. By default, only the first one is counted')
+    parser.add_argument('--cache_dir', default=CACHE_DIR, help=f'Cache directory of background tables, default = $RIBOSE_CACHE or {CACHE_DIR}')
+    parser.add_argument('--cache_size', type=float, default=1024, help='Size limit of cache in MB, least recently used tables are removed, default = 1024')
+    parser.add_argument('--no_cache', action='store_true', help='Do not read or write cache')
+    parser.add_argument('--profile', nargs='?', const='-', metavar='FILE', help='Record wall time, CPU time, bases and peak memory of each stage and chromosome, and show progress of reading the fasta. Records are printed to stderr, or saved to FILE as JSON lines')
     args = parser.parse_args()
+    if args.profile:
+        PROFILER.enable(args.profile)
 
-    if args.mono and args.trinuc:
-        sys.exit('[ERROR] Can only count mono-, dinuc- or tri-nucleotide!')
+    # tables to count, (suffix, offsets)
+    tables = []
+    if args.mono:
+        tables.append(('.mono', (0,)))
+    if args.dinuc or args.dist or not (args.mono or args.trinuc or args.dist_range or args.kmer):
+        for d in args.dist or [args.d]:
+            tables.append((f'.dinuc_d{d}', (0, d)))
+    if args.trinuc:
+        tables.append(('.trinuc', (0, 1, 2)))
+    for k in dict.fromkeys(args.kmer or []):
+        if k < 1:
+            sys.exit('[ERROR] Kmer length should be at least 1!')
+        tables.append((f'.k{k}', tuple(range(k))))
+    dists = []
+    if args.dist_range:
+        if not 1 <= args.dist_range[0] <= args.dist_range[1]:
+            sys.exit('[ERROR] Distance range should be 1 <= MIN <= MAX!')
+        dists = list(range(args.dist_range[0], args.dist_range[1] + 1))
+    if (len(tables) > 1 or dists) and args.o == '-':
+        sys.exit('[ERROR] Output basename is needed to count several tables!')
 
-    # count
-    data = defaultdict(lambda : defaultdict(int))
-    cache = ''
-    seen = set()
-    for l in args.FASTA:
-        l = l.rstrip('\n')
-        if l[0] == '>':
-            chrom = l[1:]
-            if chrom in seen and not args.allow_dup_chroms:
-                print('Skip duplicate chromosome {}!'.format(chrom))
-                chrom = None
-            else:
-                seen.add(chrom)
-                print('Start counting {}!'.format(chrom))
-            cache = ''
-        elif args.mono:
-            for i in l:
-                data[chrom][i] += 1
-        elif args.trinuc:
-            l = cache + l
-            for i in range(len(l)-2):
-                data[chrom][l[i:i+3]] += 1
-            cache = l[-2:]
+    # count, distances of the profile are counted in the same pass
+    offsets_list = [x[1] for x in tables] + [(0, d) for d in dists]
+    cache_dir = None if args.no_cache else args.cache_dir
+    with PROFILER.stage('count', threads=args.threads, tables=len(offsets_list)):
+        results = get_background(args.FASTA, offsets_list, args.threads, args.allow_dup_chroms, cache_dir, args.cache_size * 2**20)
+
+    # output, one table to file or stdout, several tables are named like count_rNMP.py
+    with PROFILER.stage('output'):
+        name = 'stdin' if args.FASTA == '-' else args.FASTA.split('/')[-1].split('.')[0]
+        if dists:
+            write_profile(generate_outputname(args.o, name) + '.dist_profile.npz', results[len(tables):], dists, args.s)
+        if len(tables) == 1 and not dists:
+            fw = sys.stdout if args.o == '-' else open(args.o, 'w')
+            write_table(fw, results[0], len(offsets_list[0]), args.s)
+            if fw is not sys.stdout:
+                fw.close()
         else:
-            l = cache + l
-            for i in range(len(l)-args.d):
-                data[chrom][l[i] + l[i+args.d]] += 1
-            cache = l[-(args.d):]
-
-    # summarize
-    result = defaultdict(lambda : defaultdict(int))
-    for chrom, v in data.items():
-        for kmer, count in v.items():
-            result[chrom][kmer.upper()] += count
-
-    # generate kmer list
-    bases = 'ACGT'
-    if args.mono:
-        nuc = list(bases)
-    elif args.trinuc:
-        nuc = [''.join(x) for x in it.product(bases, repeat=3)]
-    else:
-        nuc = [''.join(x) for x in it.product(bases, repeat=2)]
-
-    # Add opposite strand for both strands
-    if not args.s:
-        for chrom, v in data.items():
-            for n, count in v.items():
-                if n.upper() in nuc:
-                    result[chrom][rc(n.upper())] += count
-    
-    # remove skipped choromosomes
-    if None in result:
-        del result[None]
-
-    # output
-    args.o.write('Sample\t' + '\t'.join(nuc) + '\n')
-    for chrom in sorted(result.keys()):
-        args.o.write(f'{chrom}\t' + '\t'.join([str(result[chrom][kmer]) for kmer in nuc]) + '\n')
+            for (suffix, offsets), result in zip(tables, results):
+                with open(generate_outputname(args.o, name) + suffix, 'w') as fw:
+                    write_table(fw, result, len(offsets), args.s)
+    PROFILER.close()
     print('Done!')
 
 if __name__ == '__main__':
     main()
-
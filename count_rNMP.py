@@ -1,35 +1,88 @@
 #!/usr/bin/env python3
 
 import argparse
+import sys
 from rNMPUtils  import *
+from genomeUtils import input_file
+from profileUtils import PROFILER
 
 def main():
     # argparse
     parser = argparse.ArgumentParser(description='Count context frequency of rNMP incorporation')
-    parser.add_argument('GENOME', type=argparse.FileType('r'), help='Reference genome FASTA')
-    parser.add_argument('BED', type=argparse.FileType('r'), nargs='+', help='BED file of rNMP incorporation')
+    parser.add_argument('GENOME', help='Reference genome FASTA, plain or gzip/bgzip compressed, a fasta index (.fai) is used or created for plain FASTA')
+    parser.add_argument('BED', type=input_file, nargs='+', help='BED file of rNMP incorporation, plain or gzip/bgzip compressed')
     parser.add_argument('-f', action='store_true', help='Use fourth column of bed file as rNMP frequency')
     parser.add_argument('-m', action='store_true', help='Count mononucleotide frequency')
     parser.add_argument('-d', action='store_true', help='Count dinucleotide frequency')
     parser.add_argument('--dist', default=[1], type=int, nargs='+', help='distance between dinucleotides')
     parser.add_argument('-t', action='store_true', help='Count trinucleotide frequency')
+    parser.add_argument('--kmer', type=int, help='Count kmer contexts of length KMER, tables are named .k<KMER>_<orientation> like .k5_nnrnn')
+    parser.add_argument('--rpos', type=int, nargs='+', help='Positions (0-based) of the rNMP in kmer contexts, default = all positions')
+    parser.add_argument('--dist_range', type=int, nargs=2, metavar=('MIN', 'MAX'), help='Count dinucleotides of all distances from MIN to MAX in one pass, saved as one array of (library, chromosome, orientation, distance, dinucleotide) to <basename>.dist_profile.npz')
     parser.add_argument('-o', default='', help='Output basename')
+    parser.add_argument('-p', '--threads', default=1, type=int, help='Number of processes, default = 1')
+    parser.add_argument('--memory', type=float, help='Memory limit of rNMP positions in MB. BED files are streamed and sorted runs are spilled to temporary files')
+    parser.add_argument('--tmpdir', help='Directory of temporary files, default = system temporary directory')
+    parser.add_argument('--format', default='tsv', choices=['tsv', 'binary', 'both'], help='Output TSV tables, a binary container of all tables (<basename>.counts.npz), or both, default = tsv')
+    parser.add_argument('--store', help='Directory of per-library result store. Only the given BED files are counted and added to the store, outputs of all libraries in the store are updated')
+    parser.add_argument('--profile', nargs='?', const='-', metavar='FILE', help='Record wall time, CPU time, bytes, rows, rNMPs and peak memory of each stage and chromosome, and show progress of reading the genome. Records are printed to stderr, or saved to FILE as JSON lines')
     args = parser.parse_args()
+    if args.profile:
+        PROFILER.enable(args.profile)
 
-    if not(any([args.m,args.d, args.t])):
+    if args.dist_range and not 1 <= args.dist_range[0] <= args.dist_range[1]:
+        sys.exit('[ERROR] Distance range should be 1 <= MIN <= MAX!')
+    contexts = []
+    if args.kmer:
+        if args.kmer < 1:
+            sys.exit('[ERROR] Kmer length should be at least 1!')
+        if args.kmer > 8:
+            print(f'[WARNING] Each kmer table has {4**args.kmer} columns!', file=sys.stderr)
+        rpos = args.rpos if args.rpos is not None else range(args.kmer)
+        if not all(0 <= x < args.kmer for x in rpos):
+            sys.exit('[ERROR] Positions of the rNMP should be in the kmer!')
+        contexts = ['n' * x + 'r' + 'n' * (args.kmer - x - 1) for x in dict.fromkeys(rpos)]
+    elif args.rpos:
+        sys.exit('[ERROR] --rpos needs --kmer!')
+    if not(any([args.m,args.d, args.t, args.dist_range, contexts])):
         print('Count mononucleotide by default!')
         args.m = True
 
     # get position of ribose
-    libs, ribos = get_ribo_position(args.BED, args.f)
+    with PROFILER.stage('positions', libraries=len(args.BED)):
+        if args.memory:
+            libs, ribos = get_ribo_position_stream(args.BED, args.f, args.memory * 2**20, args.tmpdir)
+        else:
+            libs, ribos = get_ribo_position(args.BED, args.f)
     print('Ribonucleotides extracted!')
+    # kmer tables are dense arrays of libraries x 4^K columns for each chromosome with rNMPs
+    if contexts:
+        size = len(libs) * len(contexts) * len(ribos) * 4**args.kmer * 8
+        if size > 2**30:
+            print(f'[WARNING] Kmer tables need about {size / 2**30:.1f} GB of memory for {len(libs)} libraries, {len(contexts)} orientations and {len(ribos)} chromosomes!', file=sys.stderr)
 
     # get ribos
-    results = get_ribo(ribos, libs, args.GENOME, args.m, args.d, args.t, args.dist)
+    chroms = [] if args.store or args.format != 'tsv' or args.dist_range else None
+    with PROFILER.stage('count', threads=args.threads):
+        if args.threads > 1:
+            results = get_ribo_parallel(ribos, libs, args.GENOME, args.m, args.d, args.t, args.dist, args.threads, chroms, args.dist_range, contexts)
+        else:
+            results = get_ribo(ribos, libs, args.GENOME, args.m, args.d, args.t, args.dist, chroms, args.dist_range, contexts)
     print('Calculation finished')
 
     # output
-    output(results, args.o)
+    with PROFILER.stage('output', format=args.format):
+        if args.store:
+            params = {'frequency':args.f, 'mono':args.m, 'dinuc':args.d, 'trinuc':args.t, 'dist':args.dist if args.d else [], 'kmer':contexts}
+            names = update_store(args.store, library_tables(results, libs), params, chroms, args.o)
+            print(f'{len(names)} libraries in the store!')
+        elif args.format != 'binary':
+            output(results, libs, args.o)
+        if args.format != 'tsv':
+            write_container(container_name(args.o), results, libs, chroms)
+        if args.dist_range:
+            write_profile(container_name(args.o, 'dist_profile'), results['profile'], libs, chroms, args.dist_range)
+    PROFILER.close()
     print('Done!Output to {}!'.format(args.o))
 
 
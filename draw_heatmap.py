@@ -2,21 +2,29 @@
 
 import numpy as np
 import argparse
+import os
+import shlex
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import seaborn as sns
 import itertools as it
 from collections import defaultdict
 from matplotlib.ticker import FixedLocator
+from scipy.cluster.hierarchy import linkage, leaves_list
+from genomeUtils import open_input
+from rNMPUtils import read_table, generate_outputname
 
 
 # read data and check it is mono, di or tri nucleotide
 def load_data(data):
-    df = pd.read_csv(data, sep='\t').set_index('Sample')
-    features = list(df.columns)
+    _, features, names, values = read_table(data)
+    df = pd.DataFrame(values, index=pd.Index(names, name='Sample'), columns=features)
     # check mono, di, or tri
     nbase = len(features[0])
-    assert len(features) == 4 ** nbase, f"The header line of {data.name} is incorrect."+\
+    assert len(features) == 4 ** nbase, f"The header line of {data} is incorrect."+\
         f"Should be {4**nbase} features. Only found {len(features)} features!"
     # generate feature labels
     rNMPs = 'ACGU'
@@ -141,45 +149,179 @@ def draw(df, labels, output, no_annot, palette):
     cax.yaxis.set_major_locator(FixedLocator(tick_loc))
     cax.set_yticklabels(color_labels_texts, fontsize=font_size*100)
 
-    # show or save
+    # save and release the figure
     fig.savefig(output)
- 
+    plt.close(fig)
 
-def main():
-    # argparse
-    parser = argparse.ArgumentParser(description='Draw heatmap for rNMP incorporation mono-, di-, or tri-nucleotide data.')
-    parser.add_argument('DATA',type=argparse.FileType('r'), help='Normalized rNMP incorporation frequncy')
-    parser.add_argument('-o', default='rNMP_heatmap.png', help='Output figure name, default= rNMP_heatmap.png')
-    parser.add_argument('-b', type=argparse.FileType('r'), help='Select background file. If a file is selected, the background percentage is added to labels.')
-    parser.add_argument('--background_chrom', default='chrM', help='Chromosome name of background file, default = chrM, use with -b')
-    parser.add_argument('--no_annot', action='store_true', help='Hide percentage annotation in each cell')
-    parser.add_argument('--palette', default='icefire', help='Define the palette used for the heatmap')
-    parser.add_argument('--group_size', default=None, choices={4, 16, 64}, help='Set group size FORCELY to 4, 16, or 64')
-    parser.add_argument('--remove_empty_row', action='store_true', help='Remove empty rows in heatmap')
-    args = parser.parse_args()
 
+# draw large heatmaps as one rasterized image, figure size is bounded
+# samples are averaged to at most max_columns columns, the color scale follows group_size
+def draw_raster(df, labels, output, palette, max_columns, group_size, max_width=40):
+    font_size = 0.28
+    cmax = {4:0.5, 16:0.125, 64:1/32}[group_size]
+    samples = list(df.index)
+    if len(samples) > max_columns:
+        df = downsample(df, max_columns)
 
-    # set color settings for graph
-    sns.set(style='white')
+    # set figure size
+    label_width = len(labels[0]) * font_size + 0.2
+    show_samples = len(df) <= 200
+    sample_height = max([len(x) for x in samples]) * font_size if show_samples else 0.6
+    title_height = 0.3
+    colorbar_width = 2
+    width = min(len(df) * 0.1, max_width) + label_width + colorbar_width
+    height = len(labels) * 0.15 + sample_height + title_height
+    fig, ax = plt.subplots(figsize=(width, height))
+    plt.subplots_adjust(left=label_width/width, right=1-colorbar_width/width, \
+        top=1-title_height/height, bottom=sample_height/height)
+
+    # draw image
+    im = ax.imshow(df.T.values, aspect='auto', interpolation='nearest', cmap=palette, vmin=0, vmax=cmax)
+    ax.set_yticks(range(len(labels)))
+    ax.set_yticklabels(labels, size=font_size*30)
+    if show_samples:
+        ax.set_xticks(range(len(df)))
+        ax.set_xticklabels(df.index, rotation='vertical', size=font_size*30)
+    else:
+        ax.set_xticks([])
+        ax.set_xlabel(f'{len(samples)} samples')
+    # colorbar in the right margin, top of colorbar is 'cmax - 1'
+    cax = fig.add_axes([1-(colorbar_width-0.3)/width, sample_height/height, 0.3/width, 1-(sample_height+title_height)/height])
+    cbar = fig.colorbar(im, cax=cax)
+    ticks = np.linspace(0, cmax, 6)
+    color_labels_texts = [f'{x:g}' for x in ticks]
+    color_labels_texts[-1] += ' - 1'
+    cbar.set_ticks(ticks)
+    cbar.set_ticklabels(color_labels_texts, fontsize=font_size*30)
+
+    # save and release the figure
+    fig.savefig(output)
+    plt.close(fig)
+
+
+# average adjacent samples to n columns, named after the first sample of each column
+def downsample(df, n):
+    bins = np.arange(len(df)) * n // len(df)
+    first = np.flatnonzero(np.diff(bins, prepend=-1))
+    dfn = df.groupby(bins).mean()
+    dfn.index = df.index[first]
+    return dfn
+
+
+# order samples by average linkage hierarchical clustering of their profiles
+def cluster_samples(df):
+    if len(df) < 3:
+        return df
+    order = leaves_list(linkage(df.values, method='average'))
+    return df.iloc[order]
 
+
+# output name of a tile
+def tile_name(output, i):
+    stem, ext = os.path.splitext(output)
+    return f'{stem}_{i+1}{ext}'
+
+
+# draw the heatmap of a job = (data file, background file or None, output, figure options)
+def render(job):
+    data, bg, output, opts = job
     # get data and information
-    df, labels = load_data(args.DATA)
-    if not args.group_size:
+    df, labels = load_data(data)
+    if not opts.group_size:
         group_size = determine_group_size(df)
     else:
-        group_size = args.group_size
-    
+        group_size = opts.group_size
+
     # read background frequency
-    if args.b:
-        labels = add_bg_freq(labels, group_size, args.b, args.background_chrom)
+    if bg:
+        with open_input(bg) as fr:
+            labels = add_bg_freq(labels, group_size, fr, opts.background_chrom)
 
     # remove empty rows
-    if args.remove_empty_row:
+    if opts.remove_empty_row:
         df, labels = remove_empty(df, labels)
 
+    # order samples
+    if opts.cluster:
+        df = cluster_samples(df)
+
+    # draw heatmaps, each tile has at most opts.tile samples
+    tiles = [df]
+    outputs = [output]
+    if opts.tile and len(df) > opts.tile:
+        tiles = [df.iloc[i:i+opts.tile] for i in range(0, len(df), opts.tile)]
+        outputs = [tile_name(output, i) for i in range(len(tiles))]
+    for dft, out in zip(tiles, outputs):
+        if opts.renderer == 'raster' or (opts.renderer == 'auto' and len(dft) > opts.raster_limit):
+            draw_raster(dft, labels, out, opts.palette, opts.max_columns, group_size)
+        else:
+            draw(dft, labels, out, opts.no_annot or len(dft) > opts.annot_limit, opts.palette)
+    return ', '.join(outputs)
+
+
+# set color settings for graph
+def set_style():
+    sns.set(style='white')
+
+
+# options of each figure, also used for the options field of batch files
+def figure_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-b', help='Select background file. If a file is selected, the background percentage is added to labels.')
+    parser.add_argument('--background_chrom', default='chrM', help='Chromosome name of background file, default = chrM, use with -b')
+    parser.add_argument('--no_annot', action='store_true', help='Hide percentage annotation in each cell')
+    parser.add_argument('--palette', default='icefire', help='Define the palette used for the heatmap')
+    parser.add_argument('--group_size', default=None, type=int, choices={4, 16, 64}, help='Set group size FORCELY to 4, 16, or 64')
+    parser.add_argument('--remove_empty_row', action='store_true', help='Remove empty rows in heatmap')
+    parser.add_argument('--renderer', default='auto', choices=['auto', 'seaborn', 'raster'], help='Annotated seaborn heatmap, or rasterized image for large matrices, default = auto (raster above --raster_limit samples)')
+    parser.add_argument('--raster_limit', default=300, type=int, help='Number of samples above which the rasterized renderer is used, default = 300')
+    parser.add_argument('--annot_limit', default=100, type=int, help='Number of samples above which the annotation is hidden, default = 100')
+    parser.add_argument('--max_columns', default=2000, type=int, help='Maximum number of columns of a rasterized heatmap, adjacent samples are averaged above it, default = 2000')
+    parser.add_argument('--cluster', action='store_true', help='Order samples by hierarchical clustering')
+    parser.add_argument('--tile', type=int, help='Split samples to heatmaps of at most TILE samples, named <output>_<n>.png')
+    return parser
+
+
+def main():
+    # argparse
+    options = figure_parser()
+    parser = argparse.ArgumentParser(description='Draw heatmap for rNMP incorporation mono-, di-, or tri-nucleotide data.', parents=[options])
+    parser.add_argument('DATA', nargs='*', help='Normalized rNMP incorporation frequncy, or <container>:<library><suffix> for a table in a binary container')
+    parser.add_argument('-o', help='Output figure name, default= rNMP_heatmap.png. With several DATA files, output basename or directory of <DATA name>.png figures')
+    parser.add_argument('--batch', type=argparse.FileType('r'), help='Tab separated file with data file, background file (may be empty), output figure and figure options (e.g. --group_size 16 --no_annot) in each line')
+    parser.add_argument('-p', '--threads', default=1, type=int, help='Number of processes, default = 1')
+    args = parser.parse_args()
+
+    # jobs of (data, background, output, options)
+    fig_args = argparse.Namespace(**{k:getattr(args, k) for k in vars(options.parse_args([]))})
+    jobs = []
+    for data in args.DATA:
+        if len(args.DATA) == 1:
+            output = args.o or 'rNMP_heatmap.png'
+        else:
+            name = os.path.basename(data.rpartition(':')[2] if '.npz:' in data else data)
+            output = generate_outputname(args.o or '', name) + '.png'
+        jobs.append((data, args.b, output, fig_args))
+    if args.batch:
+        for l in args.batch:
+            ws = l.rstrip('\n').split('\t')
+            if not ws[0] or l.startswith('#'):
+                continue
+            ws += [''] * (4 - len(ws))
+            opts = options.parse_args(shlex.split(ws[3]), argparse.Namespace(**vars(fig_args)))
+            jobs.append((ws[0], ws[1] or opts.b, ws[2] or os.path.basename(ws[0]) + '.png', opts))
+    if not jobs:
+        parser.error('DATA or --batch is required')
+
     # draw heatmaps
-    draw(df, labels, args.o, args.no_annot, args.palette)
-    print(f'Heatmap is saved to {args.o}!')
+    set_style()
+    if args.threads > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(args.threads, initializer=set_style) as pool:
+            for output in pool.map(render, jobs):
+                print(f'Heatmap is saved to {output}!')
+    else:
+        for job in jobs:
+            print(f'Heatmap is saved to {render(job)}!')
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,680 @@
+
+import argparse
+import io
+import itertools as it
+import mmap
+import os
+import queue
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from profileUtils import PROFILER
+
+BASES = 'ACGT'
+
+# 2-bit code of each byte, A/C/G/T = 0/1/2/3 in both cases, other bytes = 4
+CODE = np.full(256, 4, dtype=np.uint8)
+for _i, _b in enumerate(BASES):
+    CODE[ord(_b)] = _i
+    CODE[ord(_b.lower())] = _i
+
+
+# UCSC .2bit files code bases as T, C, A, G
+TWOBIT_SIGNATURE = 0x1A412743
+CODE_TO_TWOBIT = np.array([2, 1, 3, 0, 0], dtype=np.uint8)
+# bases of each packed byte
+UNPACK = np.array([3, 1, 0, 2], dtype=np.uint8)[(np.arange(256)[:, None] >> np.array([6, 4, 2, 0])) & 3]
+
+
+# encode sequence bytes to 2-bit codes
+def encode(seq):
+    return CODE[np.frombuffer(seq, dtype=np.uint8)]
+
+
+# all kmers in the order of count arrays
+def kmer_list(k):
+    return [''.join(x) for x in it.product(BASES, repeat=k)]
+
+
+# index of the reverse complement of each kmer
+def rc_index(k):
+    idx = np.arange(4**k)
+    r = np.zeros(4**k, dtype=np.intp)
+    for _ in range(k):
+        r = r * 4 + 3 - idx % 4
+        idx //= 4
+    return r
+
+
+# kmer index of each window, bases are taken at offsets from window start
+# windows with non-ACGT bases are -1
+def kmer_index(codes, offsets):
+    n = len(codes) - max(offsets)
+    if n <= 0:
+        return np.empty(0, dtype=np.intp)
+    idx = np.zeros(n, dtype=np.intp)
+    bad = np.zeros(n, dtype=bool)
+    for o in offsets:
+        c = codes[o:o+n]
+        idx <<= 2
+        idx += c
+        bad |= c > 3
+    idx[bad] = -1
+    return idx
+
+
+# base-5 index of each kmer, codes of other bytes (4) are the fifth digit
+def base5_index(k):
+    kmers = np.arange(4**k)
+    idx = np.zeros(4**k, dtype=np.intp)
+    for i in range(k - 1, -1, -1):
+        idx = idx * 5 + (kmers >> 2 * i & 3)
+    return idx
+
+
+# count kmers of 2-bit codes, return counts and number of windows
+# kmers up to 10 bases are counted in base 5 in small integers without masking non-ACGT windows
+def count_codes(codes, offsets):
+    k = len(offsets)
+    n = len(codes) - max(offsets)
+    if n <= 0 or 5**k > 1<<24:
+        idx = kmer_index(codes, offsets)
+        return np.bincount(idx[idx >= 0], minlength=4**k), len(idx)
+    idx = codes[offsets[0]:offsets[0]+n].astype(np.uint8 if 5**k <= 1<<8 else np.uint16 if 5**k <= 1<<16 else np.uint32)
+    for o in offsets[1:]:
+        idx *= 5
+        idx += codes[o:o+n]
+    return np.bincount(idx, minlength=5**k)[base5_index(k)], n
+
+
+# read fasta by blocks, yield (chrom, None) for each header and (chrom, seq) for sequences
+# newlines are removed from seq, a block never contains sequence of two chromosomes
+def read_fasta(fr, block_size=1<<22):
+    chrom = None
+    buf = b''
+    line_start = True
+    while True:
+        data = fr.read(block_size)
+        buf += data
+        i = 0
+        while i < len(buf):
+            if line_start and buf[i] == ord('>'):
+                j = buf.find(b'\n', i)
+                if j == -1:
+                    # wait for the rest of the header
+                    if data:
+                        break
+                    j = len(buf)
+                chrom = buf[i+1:j].rstrip(b'\r').decode()
+                yield chrom, None
+                i = j + 1
+            else:
+                j = buf.find(b'\n>', i)
+                j = len(buf) if j == -1 else j + 1
+                seq = buf[i:j].translate(None, b'\r\n')
+                line_start = buf[j-1] == ord('\n')
+                i = j
+                if seq:
+                    yield chrom, seq
+        buf = buf[i:]
+        if not data:
+            break
+
+
+# check gzip magic number of a file
+def is_gzip(path):
+    if path == '-' or not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as fr:
+        return fr.read(2) == b'\x1f\x8b'
+
+
+# gzip file decompressed in a background thread, bgzip blocks are decompressed in parallel
+# the thread starts at the first read, and at most max_bytes of decompressed data wait in the queue
+class GzipReader(io.RawIOBase):
+    # size of decompressed pieces in the queue, bgzip blocks are at most 64 KB
+    PIECE = 1<<16
+
+    def __init__(self, fr, name, threads=4, max_bytes=1<<24):
+        self.fr = fr
+        self.name = name
+        self.buf = b''
+        self.queue = queue.Queue(max(max_bytes // self.PIECE, 1))
+        self.threads = threads
+        self.thread = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.decompress, daemon=True)
+            self.thread.start()
+        while not self.buf:
+            data = self.queue.get()
+            if isinstance(data, Exception):
+                raise data
+            if data is None:
+                self.queue.put(None)
+                return 0
+            self.buf = data
+        n = min(len(b), len(self.buf))
+        b[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+
+    # producer thread, put decompressed pieces to queue and None at the end
+    def decompress(self):
+        try:
+            head = self.fr.peek(18)[:18] if hasattr(self.fr, 'peek') else b''
+            # bgzip, gzip header with BC extra subfield
+            if len(head) == 18 and head[3] & 4 and head[12:14] == b'BC':
+                with ThreadPoolExecutor(self.threads) as pool:
+                    while True:
+                        blocks = list(it.islice(iter(self.read_bgzf_block, None), self.threads * 16))
+                        if not blocks:
+                            break
+                        for data in pool.map(inflate_bgzf_block, blocks):
+                            self.queue.put(data)
+            # gzip with one or more members
+            else:
+                d = zlib.decompressobj(31)
+                data = self.fr.read(1<<20)
+                while True:
+                    out = d.decompress(data, self.PIECE)
+                    if out:
+                        self.queue.put(out)
+                    data = d.unused_data if d.eof else d.unconsumed_tail
+                    # decompressed data may be left in the decompressor when a piece is full
+                    if not data and (d.eof or len(out) < self.PIECE):
+                        data = self.fr.read(1<<20)
+                        if not data:
+                            break
+                    # next member
+                    if d.eof and data:
+                        d = zlib.decompressobj(31)
+                if not d.eof:
+                    raise EOFError(f'Compressed file {self.name} ended before the end-of-stream marker was reached')
+            self.queue.put(None)
+        except Exception as e:
+            self.queue.put(e)
+
+    # compressed data of next bgzip block, None at the end
+    def read_bgzf_block(self):
+        header = self.fr.read(12)
+        if not header:
+            return None
+        if len(header) < 12:
+            raise EOFError(f'Compressed file {self.name} ended in the middle of a bgzip block')
+        xlen, = struct.unpack_from('<H', header, 10)
+        extra = self.fr.read(xlen)
+        i = 0
+        while extra[i:i+2] != b'BC':
+            if i + 4 > len(extra):
+                raise EOFError(f'Compressed file {self.name} ended in the middle of a bgzip block')
+            i += 4 + struct.unpack_from('<H', extra, i + 2)[0]
+        if i + 6 > len(extra):
+            raise EOFError(f'Compressed file {self.name} ended in the middle of a bgzip block')
+        bsize, = struct.unpack_from('<H', extra, i + 4)
+        block = self.fr.read(bsize - xlen - 11)
+        if len(block) < bsize - xlen - 11:
+            raise EOFError(f'Compressed file {self.name} ended in the middle of a bgzip block')
+        return block
+
+    def close(self):
+        if not self.closed and self.fr is not sys.stdin.buffer:
+            self.fr.close()
+        super().close()
+
+
+# decompress the data of a bgzip block, the last 8 bytes are crc32 and size
+def inflate_bgzf_block(block):
+    data = zlib.decompress(block[:-8], -15)
+    crc, size = struct.unpack_from('<2I', block, len(block) - 8)
+    if zlib.crc32(data) != crc or len(data) != size:
+        raise ValueError('Corrupted bgzip block!')
+    return data
+
+
+# argparse type of an input file, the file is only checked here and opened later with open_input
+def input_file(path):
+    if path != '-':
+        try:
+            open(path, 'rb').close()
+        except OSError as e:
+            raise argparse.ArgumentTypeError(f"can't open '{path}': {e}")
+    return path
+
+
+# argparse type of an output file or basename, '-' for stdout
+# the file is not created here, but its directory is checked to be writable before any counting
+def output_file(path):
+    if path != '-':
+        d = path if os.path.isdir(path) else os.path.dirname(path) or '.'
+        if not os.path.isdir(d) or not os.access(d, os.W_OK) or (os.path.isfile(path) and not os.access(path, os.W_OK)):
+            raise argparse.ArgumentTypeError(f"can't write '{path}'")
+    return path
+
+
+# open plain or gzip compressed input, '-' for stdin
+def open_input(path, mode='r'):
+    fr = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    if fr.peek(2)[:2] == b'\x1f\x8b':
+        fr = io.BufferedReader(GzipReader(fr, path), 1<<20)
+    if mode == 'rb':
+        return fr
+    return io.TextIOWrapper(fr)
+
+
+# bytes of the file read so far by a reader of open_input, compressed bytes for gzip, None for pipes and in-memory text
+def input_offset(fr):
+    fr = underlying_file(fr)
+    return fr.tell() if fr is not None and fr.seekable() else None
+
+
+# size in bytes of the file of a reader of open_input, compressed size for gzip, None for pipes and in-memory text
+# stdin redirected from a file has a size
+def input_size(fr):
+    fr = underlying_file(fr)
+    if fr is None or not fr.seekable():
+        return None
+    try:
+        return os.fstat(fr.fileno()).st_size
+    except OSError:
+        return None
+
+
+# the underlying file object of a reader of open_input
+def underlying_file(fr):
+    raw = getattr(fr, 'raw', None)
+    return raw.fr if isinstance(raw, GzipReader) else fr
+
+
+# build samtools compatible fasta index, [name, length, offset, linebases, linewidth] for each chromosome
+# return None if the lines are not regular and the file cannot be indexed
+def build_fai(path):
+    index = []
+    offset = 0
+    with open(path, 'rb') as fr:
+        for l in fr:
+            if l[:1] == b'>':
+                ws = l[1:].split()
+                entry = [ws[0].decode() if ws else '', 0, offset + len(l), 0, 0]
+                index.append(entry)
+                short = False
+            elif index:
+                bases = len(l.rstrip(b'\r\n'))
+                eol = len(l) - bases
+                if not entry[3]:
+                    if not bases:
+                        return None
+                    entry[3], entry[4] = bases, len(l)
+                # only the last line of a chromosome can be shorter
+                elif short or bases > entry[3] or (eol and eol != entry[4] - entry[3]):
+                    return None
+                if bases < entry[3] or not eol:
+                    short = True
+                entry[1] += bases
+            elif l.strip():
+                return None
+            offset += len(l)
+    return index
+
+
+# read fasta index, create one if it is missing or outdated
+# return None if the fasta cannot be indexed
+def load_fai(path):
+    fai = path + '.fai'
+    if os.path.isfile(fai) and os.path.getmtime(fai) >= os.path.getmtime(path):
+        with open(fai) as fr:
+            index = []
+            for l in fr:
+                ws = l.rstrip('\n').split('\t')
+                index.append([ws[0]] + list(map(int, ws[1:5])))
+        return index
+    index = build_fai(path)
+    if index is None:
+        return None
+    try:
+        with open(fai, 'w') as fw:
+            for entry in index:
+                fw.write('\t'.join(map(str, entry)) + '\n')
+    except OSError:
+        print(f'[WARNING] Cannot write fasta index {fai}, index is kept in memory!', file=sys.stderr)
+    return index
+
+
+# full header line of an indexed chromosome
+def fai_header(mm, entry):
+    start = mm.rfind(b'\n', 0, entry[2] - 1) + 1
+    header = mm[start:entry[2]].rstrip(b'\r\n')
+    if header[:1] != b'>':
+        raise ValueError(f'Fasta index does not match the fasta file at chromosome {entry[0]}')
+    return header[1:].decode()
+
+
+# sequence of an indexed chromosome in [start, end) without newlines
+def fai_fetch(mm, entry, start, end):
+    _, length, offset, linebases, linewidth = entry
+    a = offset + start // linebases * linewidth + start % linebases
+    b = offset + end // linebases * linewidth + end % linebases
+    return mm[a:b].translate(None, b'\r\n')
+
+
+# read fasta like read_fasta, using fasta index when possible
+# chromosomes rejected by keep() are skipped without being read
+def iter_fasta(path, keep=None, block_size=1<<22):
+    index = None
+    if path != '-' and os.path.isfile(path) and os.path.getsize(path) and not is_gzip(path):
+        index = load_fai(path)
+    # stream the whole file
+    if index is None:
+        fr = open_input(path, 'rb')
+        total = input_size(fr) if PROFILER.enabled else None
+        skip = False
+        for chrom, seq in read_fasta(fr, block_size):
+            if total:
+                PROFILER.progress(path, input_offset(fr), total)
+            if seq is None:
+                skip = keep is not None and not keep(chrom)
+                if not skip:
+                    yield chrom, None
+            elif not skip:
+                yield chrom, seq
+        if fr is not sys.stdin.buffer:
+            fr.close()
+        return
+    # random access
+    with open(path, 'rb') as fr, mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for entry in index:
+            chrom = fai_header(mm, entry)
+            if keep is not None and not keep(chrom):
+                continue
+            yield chrom, None
+            for start in range(0, entry[1], block_size):
+                end = min(start + block_size, entry[1])
+                PROFILER.progress(path, entry[2] + end // entry[3] * entry[4], len(mm))
+                yield chrom, fai_fetch(mm, entry, start, end)
+
+
+# 2bit file prepared for a fasta file, None if there is no up-to-date one
+def twobit_path(path):
+    if path.endswith('.2bit'):
+        return path
+    if path != '-' and os.path.isfile(path + '.2bit') and os.path.getmtime(path + '.2bit') >= os.path.getmtime(path):
+        return path + '.2bit'
+    return None
+
+
+# runs of True in mask as (starts, sizes), starts are shifted by offset
+def find_runs(mask, offset=0):
+    d = np.diff(mask.astype(np.int8), prepend=0, append=0)
+    starts = np.flatnonzero(d == 1)
+    return starts + offset, np.flatnonzero(d == -1) - starts
+
+
+# merge adjacent runs
+def merge_runs(starts, sizes):
+    if not len(starts):
+        return starts, sizes
+    ends = starts + sizes
+    first = np.concatenate([[True], starts[1:] != ends[:-1]])
+    last = np.concatenate([first[1:], [True]])
+    return starts[first], ends[last] - starts[first]
+
+
+# write UCSC .2bit file with N and soft-masked (lowercase) blocks of a fasta file
+# chromosome names are full header lines
+def write_2bit(fasta, output):
+    names = []
+    offsets = []
+    with tempfile.TemporaryFile() as tmp:
+        record = None
+        for chrom, seq in it.chain(iter_fasta(fasta), [(None, None)]):
+            if seq is None:
+                if record is not None:
+                    offsets.append(tmp.tell())
+                    write_2bit_record(tmp, record)
+                if chrom is None:
+                    break
+                if len(chrom.encode()) > 255:
+                    raise ValueError(f'Chromosome name is longer than 255 bytes: {chrom}')
+                names.append(chrom.encode())
+                record = {'length':0, 'packed':[], 'rest':np.empty(0, dtype=np.uint8), 'n':[], 'mask':[]}
+                continue
+            if record is None:
+                continue
+            raw = np.frombuffer(seq, dtype=np.uint8)
+            codes = CODE[raw]
+            record['n'].append(find_runs(codes == 4, record['length']))
+            record['mask'].append(find_runs((raw >= ord('a')) & (raw <= ord('z')), record['length']))
+            record['length'] += len(codes)
+            # pack 4 bases to a byte, the rest is packed with next block
+            codes = np.concatenate([record['rest'], CODE_TO_TWOBIT[codes]])
+            n = len(codes) // 4 * 4
+            record['packed'].append(pack_twobit(codes[:n]))
+            record['rest'] = codes[n:]
+        # header and index
+        index_size = sum(len(x) + 1 for x in names)
+        version = 0
+        if 16 + index_size + 4 * len(names) + tmp.tell() >= 2**32:
+            version = 1
+        start = 16 + index_size + (8 if version else 4) * len(names)
+        with open(output, 'wb') as fw:
+            fw.write(struct.pack('<4I', TWOBIT_SIGNATURE, version, len(names), 0))
+            for name, offset in zip(names, offsets):
+                fw.write(struct.pack('<B', len(name)) + name + struct.pack('<Q' if version else '<I', start + offset))
+            tmp.seek(0)
+            shutil.copyfileobj(tmp, fw, 1<<24)
+
+
+# pack 2bit codes, 4 bases in a byte with the first base in the highest bits
+def pack_twobit(codes):
+    codes = codes.reshape(-1, 4)
+    return (codes[:, 0] << 6 | codes[:, 1] << 4 | codes[:, 2] << 2 | codes[:, 3]).astype(np.uint8).tobytes()
+
+
+# write one chromosome of .2bit file
+def write_2bit_record(fw, record):
+    rest = record['rest']
+    packed = record['packed'] + [pack_twobit(np.concatenate([rest, np.zeros((4 - len(rest)) % 4, dtype=np.uint8)]))]
+    fw.write(struct.pack('<I', record['length']))
+    for k in ['n', 'mask']:
+        starts, sizes = merge_runs(*[np.concatenate(x).astype('<u4') for x in zip(*record[k])]) if record[k] else (np.empty(0, '<u4'), np.empty(0, '<u4'))
+        fw.write(struct.pack('<I', len(starts)) + starts.tobytes() + sizes.tobytes())
+    fw.write(struct.pack('<I', 0))
+    for x in packed:
+        fw.write(x)
+
+
+# read .2bit index, [name, length, dna offset, N block starts, N block ends] of each chromosome
+def read_2bit_index(mm):
+    signature, version, count, _ = struct.unpack_from('<4I', mm, 0)
+    if signature != TWOBIT_SIGNATURE:
+        raise ValueError('Not a .2bit file!')
+    index = []
+    pos = 16
+    for _ in range(count):
+        size = mm[pos]
+        name = mm[pos+1:pos+1+size].decode()
+        offset, = struct.unpack_from('<Q' if version else '<I', mm, pos + 1 + size)
+        pos += 1 + size + (8 if version else 4)
+        length, nblock = struct.unpack_from('<2I', mm, offset)
+        nstarts = np.frombuffer(mm, dtype='<u4', count=nblock, offset=offset + 8).astype(np.int64)
+        nends = nstarts + np.frombuffer(mm, dtype='<u4', count=nblock, offset=offset + 8 + 4 * nblock)
+        offset += 8 + 8 * nblock
+        mblock, = struct.unpack_from('<I', mm, offset)
+        index.append([name, length, offset + 8 + 8 * mblock, nstarts, nends])
+    return index
+
+
+# 2-bit encoded sequence of a .2bit chromosome in [start, end)
+def twobit_fetch(mm, entry, start, end):
+    _, _, offset, nstarts, nends = entry
+    a, b = start // 4, (end + 3) // 4
+    codes = UNPACK[np.frombuffer(mm, dtype=np.uint8, count=b - a, offset=offset + a)].ravel()[start - a * 4:end - a * 4]
+    # N blocks overlapping the window
+    i, j = np.searchsorted(nends, start, side='right'), np.searchsorted(nstarts, end)
+    if j > i:
+        n = end - start
+        d = np.bincount(np.clip(nstarts[i:j] - start, 0, n), minlength=n+1) - np.bincount(np.clip(nends[i:j] - start, 0, n), minlength=n+1)
+        codes[np.cumsum(d[:n]) > 0] = 4
+    return codes
+
+
+# (chrom, index entry) of each chromosome in a .2bit or indexed fasta, None if it cannot be indexed
+def indexed_chroms(path):
+    store = twobit_path(path)
+    if store is not None:
+        with open(store, 'rb') as fr, mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return [(entry[0], entry) for entry in read_2bit_index(mm)]
+    if path == '-' or not os.path.isfile(path) or not os.path.getsize(path) or is_gzip(path):
+        return None
+    index = load_fai(path)
+    if index is None:
+        return None
+    with open(path, 'rb') as fr, mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return [(fai_header(mm, entry), entry) for entry in index]
+
+
+# 2-bit encoded sequence of an indexed chromosome in [start, end)
+def fetch_codes(path, entry, start, end):
+    store = twobit_path(path)
+    with open(store or path, 'rb') as fr, mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if store is not None:
+            return twobit_fetch(mm, entry, start, end)
+        return encode(fai_fetch(mm, entry, start, end))
+
+
+# read 2-bit encoded sequence like iter_fasta, from .2bit file if it is prepared
+def iter_codes(path, keep=None, block_size=1<<22):
+    store = twobit_path(path)
+    if store is None:
+        for chrom, seq in iter_fasta(path, keep, block_size):
+            yield chrom, None if seq is None else encode(seq)
+        return
+    with open(store, 'rb') as fr, mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for entry in read_2bit_index(mm):
+            if keep is not None and not keep(entry[0]):
+                continue
+            yield entry[0], None
+            for start in range(0, entry[1], block_size):
+                end = min(start + block_size, entry[1])
+                PROFILER.progress(store, entry[2] + end // 4, len(mm))
+                yield entry[0], twobit_fetch(mm, entry, start, end)
+
+
+# read 2-bit encoded sequence of each chromosome kept by keep()
+def read_chroms(path, keep=None):
+    cr = None
+    blocks = []
+    for chrom, codes in iter_codes(path, keep):
+        if codes is None:
+            if cr is not None:
+                yield cr, np.concatenate(blocks) if blocks else np.empty(0, dtype=np.uint8)
+            cr = chrom
+            blocks = []
+        else:
+            blocks.append(codes)
+    if cr is not None:
+        yield cr, np.concatenate(blocks) if blocks else np.empty(0, dtype=np.uint8)
+
+
+# prefix sums of kmer counts of each chromosome every stride bases, for kmers of length 1 to max_k
+# prefix_k{k}[starts[i] + j] = counts of kmers starting before j * stride in the i-th chromosome
+# return None if the genome cannot be indexed
+def build_kmer_index(path, stride=1<<14, max_k=3, chunk_size=1<<22):
+    chroms = indexed_chroms(path)
+    if chroms is None:
+        return None
+    step = max(chunk_size // stride, 1) * stride
+    dtype = np.uint32 if max([entry[1] for _, entry in chroms] + [0]) < 2**32 else np.uint64
+    starts = []
+    prefix = {k:[] for k in range(1, max_k + 1)}
+    n = 0
+    for chrom, entry in chroms:
+        nblock = -(-entry[1] // stride)
+        starts.append(n)
+        n += nblock + 1
+        blocks = {k:np.zeros((nblock, 4**k), dtype=np.int64) for k in prefix}
+        for start in range(0, entry[1], step):
+            end = min(start + step, entry[1])
+            codes = fetch_codes(path, entry, start, min(end + max_k - 1, entry[1]))
+            j = start // stride
+            nb = -(-(end - start) // stride)
+            for k, v in blocks.items():
+                # kmers are counted in the block of their first base
+                idx = kmer_index(codes[:end - start + k - 1], tuple(range(k)))
+                block = np.arange(len(idx)) // stride
+                m = idx >= 0
+                v[j:j+nb] += np.bincount(block[m] * 4**k + idx[m], minlength=nb * 4**k).reshape(nb, 4**k)
+        for k, v in blocks.items():
+            prefix[k].append(np.zeros((1, 4**k), dtype=dtype))
+            prefix[k].append(np.cumsum(v, axis=0).astype(dtype))
+    index = {'chromosomes':np.array([x for x, _ in chroms], dtype=str), 'lengths':np.array([entry[1] for _, entry in chroms], dtype=np.int64),
+             'starts':np.array(starts, dtype=np.int64), 'stride':np.array(stride), 'max_k':np.array(max_k)}
+    for k, v in prefix.items():
+        index[f'prefix_k{k}'] = np.concatenate(v) if v else np.empty((0, 4**k), dtype=dtype)
+    return index
+
+
+# kmer index of a genome, kept in <genome>.kidx.npz and built again if the genome or the parameters change
+def load_kmer_index(path, stride=1<<14, max_k=3):
+    kidx = path + '.kidx.npz'
+    if os.path.isfile(kidx) and os.path.getmtime(kidx) >= os.path.getmtime(path):
+        with np.load(kidx) as data:
+            if int(data['stride']) == stride and int(data['max_k']) >= max_k:
+                return dict(data)
+    index = build_kmer_index(path, stride, max_k)
+    if index is None:
+        return None
+    try:
+        with open(kidx, 'wb') as fw:
+            np.savez(fw, **index)
+    except OSError:
+        print(f'[WARNING] Cannot write kmer index {kidx}, index is kept in memory!', file=sys.stderr)
+    return index
+
+
+# kmer counts of regions [(chromosome index, start, end)] in kmer_list order, kmers have to be inside a region
+# kmers before each end of a region are taken from the prefix sum at the nearest block boundary,
+# and bases between the end and the boundary are read from the genome, so at most stride / 2 bases are read
+def query_kmer_index(path, index, regions, k):
+    stride = int(index['stride'])
+    prefix = index[f'prefix_k{k}']
+    entries = [entry for _, entry in indexed_chroms(path)]
+    offsets = tuple(range(k))
+    counts = np.zeros(4**k, dtype=np.int64)
+
+    # counts of kmers starting in [a, b)
+    def scan(entry, a, b):
+        return count_codes(fetch_codes(path, entry, a, b + k - 1), offsets)[0]
+
+    # counts of kmers starting before x
+    def before(i, entry, x):
+        last = entry[1] - k + 1
+        j = (x + stride // 2) // stride
+        y = min(j * stride, last)
+        c = prefix[index['starts'][i] + j].astype(np.int64)
+        if x > y:
+            c += scan(entry, y, x)
+        elif x < y:
+            c -= scan(entry, x, y)
+        return c
+
+    for i, start, end in regions:
+        entry = entries[i]
+        # starts of kmers
+        a, b = max(start, 0), min(end, entry[1]) - k + 1
+        if a >= b:
+            continue
+        if b - a <= stride:
+            counts += scan(entry, a, b)
+        else:
+            counts += before(i, entry, b) - before(i, entry, a)
+    return counts
@@ -1,17 +1,60 @@
 #!/usr/bin/env python3
 
 import argparse
+import fnmatch
+import re
 import sys
+import io
+import numpy as np
+from genomeUtils import open_input
+from rNMPUtils import table_file, split_table_spec, read_table, read_matrix
+
+# check whether the chromosome matches any pattern
+# patterns are regular expressions with 're:' prefix, globs with *, ? or [], or exact names
+def match_chromosome(s, patterns):
+    for p in patterns:
+        if p.startswith('re:'):
+            if re.fullmatch(p[3:], s):
+                return True
+        elif any(c in p for c in '*?['):
+            if fnmatch.fnmatchcase(s, p):
+                return True
+        elif s == p:
+            return True
+    return False
+
+
+# header, chromosomes and values of a table, and its lines to append with -a
+# tables in a container are read as arrays, files are only kept as text when their lines are appended
+def read_rows(spec, keep_lines):
+    if not keep_lines:
+        header, _, chroms, freqs = read_table(spec)
+        return header, chroms, freqs, []
+    if split_table_spec(spec)[0] is not None:
+        header, _, chroms, freqs = read_table(spec)
+        return header, chroms, freqs, [cr + '\t' + '\t'.join(map(str, v)) + '\n' for cr, v in zip(chroms, freqs.tolist())]
+    with open_input(spec) as fr:
+        lines = fr.readlines()
+    header, _, chroms, freqs = read_matrix(io.StringIO(''.join(lines)))
+    return header, chroms, freqs, lines[1:]
+
+
+# warn about globs that look like regular expressions, e.g. chr[0-9XY]+ instead of re:chr[0-9XY]+
+def check_patterns(patterns):
+    for p in patterns:
+        if not p.startswith('re:') and any(c in p for c in '*?[') and any(c in p for c in '+()|{}^$'):
+            print(f'[WARNING] Pattern {p} is matched as a glob, use re:{p} for a regular expression!', file=sys.stderr)
+
 
 # check whether the chromosome is demanded
 def check_chromosome(s, crs, v):
     if v:
-        if s in crs:
+        if match_chromosome(s, crs):
             return False
         else:
             return True
     else:
-        if s in crs:
+        if match_chromosome(s, crs):
             return True
         else:
             return False
@@ -20,40 +63,52 @@ def check_chromosome(s, crs, v):
 def main():
     # argument parser
     parser=argparse.ArgumentParser(description='Find specific chromosome(s) from rNMP incorporation or background frequency files')
-    parser.add_argument('infile', nargs='+', type=argparse.FileType('r'), default=sys.stdin, help='rNMP incorporation of background frequency files')
+    parser.add_argument('infile', nargs='+', type=table_file, help='rNMP incorporation of background frequency files, plain or gzip compressed, or <container>:<library><suffix> for a table in a binary container')
     parser.add_argument('-o', type=argparse.FileType('w'), default=sys.stdout, help='Output, default = stdout')
-    parser.add_argument('-s', default=['chrM'], nargs = '+', help='Strings to capture, default = chrM')
+    parser.add_argument('-s', default=['chrM'], nargs = '+', help='Chromosomes to capture, names, globs (e.g. scaffold_*) or regular expressions with \'re:\' prefix (e.g. re:chr[0-9XY]+), default = chrM')
     parser.add_argument('-v', action='store_true', help='Select non-matching chromosomes')
     parser.add_argument('-a', action='store_true', help='Append to original file')
     parser.add_argument('--name', help='Name for the output line, default = input file name')
+    parser.add_argument('--group', nargs='+', action='append', default=[], metavar=('OUTPUT', 'PATTERN'), help='Output file and chromosome patterns of a selection group, can be repeated. All groups are selected in one pass, -s, -v and -o are ignored')
+    parser.add_argument('--vgroup', nargs='+', action='append', default=[], metavar=('OUTPUT', 'PATTERN'), help='Output file and chromosome patterns of a selection group of non-matching chromosomes, can be repeated')
     args=parser.parse_args()
 
-    # header
-    header = args.infile[0].readline()
-    args.o.write(header)
-    col_num = len(header.split()) - 1
+    # selection groups of (output, patterns, select non-matching)
+    groups = []
+    for g, v in [(x, False) for x in args.group] + [(x, True) for x in args.vgroup]:
+        if len(g) < 2:
+            parser.error('Each group needs an output file and at least one pattern')
+        groups.append((open(g[0], 'w'), g[1:], v))
+    if not groups:
+        groups = [(args.o, args.s, args.v)]
+    for fw, crs, v in groups:
+        check_patterns(crs)
 
     # search
-    for fr in args.infile:
-        fr.seek(0)
-        # remove first line
-        l = fr.readline()
-        freq = []
-        for l in fr:
-            if args.a:
-                args.o.write(l)
-            cr = l.split('\t')[0]
-            if check_chromosome(cr, args.s, args.v):
-                try:
-                    freq = [freq[i] + float(l.split('\t')[i+1]) for i in range(col_num)]
-                except IndexError:
-                    freq = list(map(lambda x : float(x), l.split('\t')[1:]))
+    selected = [{} for g in groups]
+    for i, spec in enumerate(args.infile):
+        header, chroms, freqs, lines = read_rows(spec, args.a)
+        # header from the first file
+        if i == 0:
+            for fw, crs, v in groups:
+                fw.write(header)
         if not args.name:
-            name = fr.name.split('/')[-1].split('.')[0]
+            name = ('<stdin>' if spec == '-' else split_table_spec(spec)[1]).split('/')[-1].split('.')[0]
         else:
             name = args.name
-        args.o.write( name +'\t'+ '\t'.join([str(i) for i in freq]) + '\n')
+        # sum up selected chromosomes of each group in file order
+        for (fw, crs, v), cache in zip(groups, selected):
+            if args.a:
+                fw.writelines(lines)
+            m = [cache[cr] if cr in cache else cache.setdefault(cr, check_chromosome(cr, crs, v)) for cr in chroms]
+            if not any(m):
+                print(f'[WARNING] No chromosome of {spec} is selected by {" ".join(crs)}{" with -v" if v else ""}, the row of {name} is empty!', file=sys.stderr)
+            freq = np.cumsum(freqs[m], axis=0)[-1].tolist() if any(m) else []
+            fw.write( name +'\t'+ '\t'.join([str(i) for i in freq]) + '\n')
 
+    for fw, crs, v in groups:
+        if fw is not sys.stdout:
+            fw.close()
     print("Done!")
 
 
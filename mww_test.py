@@ -2,58 +2,91 @@
 
 import sys
 import argparse
+import numpy as np
 from scipy.stats import mannwhitneyu as mww
+from genomeUtils import input_file, open_input
+from rNMPUtils import generate_outputname
 
 
-# read data
+# read data, data[celltype] = matrix of samples x features
 def read_data(fr):
-    data = {}
     header = fr.readline().rstrip('\n').split('\t')[1:]
-    data['all'] = {k:[] for k in header}
+    rows = {'all':[]}
     for l in fr:
         ws = l.rstrip('\n').split('\t')
         name = ws[0]
         c = name.split('-')
         cate = '-'.join(c[:-1])
-        if cate not in data:
-            data[cate] = {k:[] for k in header}
-        for i in range(len(ws[1:])):
-            data[cate][header[i]].append(float(ws[i+1]))
-            data['all'][header[i]].append(float(ws[i+1]))
+        values = list(map(float, ws[1:]))
+        rows.setdefault(cate, []).append(values)
+        rows['all'].append(values)
+    data = {k:np.array(v, dtype=float).reshape(len(v), len(header)) for k, v in rows.items()}
     return data, header
 
 
+# p values of each feature (column) against the baseline, all features are tested at once
+def mww_test(d, baseline):
+    _, p = mww(d, np.full(d.shape, baseline), alternative='greater', axis=0)
+    return p
+
+
+# adjust p values of all tests in a matrix, nan are not counted as tests
+def adjust_p(p, method):
+    flat = p.ravel()
+    m = np.count_nonzero(~np.isnan(flat))
+    adjusted = np.full(flat.shape, np.nan)
+    if method == 'bonferroni':
+        adjusted = np.minimum(flat * m, 1)
+    elif method == 'bh':
+        # step-up from the largest p value
+        order = np.argsort(flat)[:m]
+        q = flat[order] * m / np.arange(1, m + 1)
+        adjusted[order] = np.minimum(np.minimum.accumulate(q[::-1])[::-1], 1)
+    return adjusted.reshape(p.shape)
+
+
 def main():
     # argparse
     parser = argparse.ArgumentParser(description='Perform Mann-Whitney U test for heatmap data')
-    parser.add_argument('tsv', type=argparse.FileType('r'), help='Normalized frequency file')
-    parser.add_argument('-o', type=argparse.FileType('w'), default=sys.stdout, help='Output to file')
+    parser.add_argument('tsv', nargs='+', type=input_file, help='Normalized frequency file(s), plain or gzip compressed, \'-\' for stdin')
+    parser.add_argument('-o', default='-', help='Output to file, default = stdout. With several input files, output basename or directory of <input name>.mww.tsv files')
     parser.add_argument('--baseline', type=float, default=-1, help='Baseline value to compare with, default: infer from heatmap data')
     parser.add_argument('--min', type=int, default=4, help='Min sample number to keep the group, default: 4')
+    parser.add_argument('--adjust', nargs='+', default=[], choices=['bh', 'bonferroni'], help='Add columns of p values adjusted over all tests of a file with Benjamini-Hochberg or Bonferroni correction')
     args = parser.parse_args()
 
-    # read data
-    data, header = read_data(args.tsv)
-    n = len(header[0])
-    if args.baseline == -1:
-        if n == 1 or n == 2:
-            args.baseline = 0.25
+    for tsv in args.tsv:
+        # read data
+        with open_input(tsv) as fr:
+            data, header = read_data(fr)
+        n = len(header[0])
+        baseline = args.baseline
+        if baseline == -1:
+            if n == 1 or n == 2:
+                baseline = 0.25
+            else:
+                baseline = 1/16
+
+        # perform mww test
+        celltypes = [k for k, v in data.items() if len(v) >= args.min]
+        p = np.array([mww_test(data[k], baseline) for k in celltypes]).reshape(len(celltypes), len(header))
+        columns = [p] + [adjust_p(p, x) for x in args.adjust]
+
+        # output
+        if len(args.tsv) == 1:
+            output = args.o
         else:
-            args.baseline = 1/16
-
-    # perform mww test
-    args.o.write(f'Celltype\t' + '\t'.join(header) + '\n')
-    for celltype, v in data.items():
-        # check
-        if len(list(v.values())[0]) < args.min:
-            continue
-        args.o.write(f'{celltype}')
-        for k in header:
-            d = v[k]
-            _, p = mww(d, [args.baseline]*len(d), alternative='greater')
-            args.o.write(f'\t{p}')
-        args.o.write('\n')
-        
+            output = generate_outputname('' if args.o == '-' else args.o, tsv.split('/')[-1].split('.')[0]) + '.mww.tsv'
+        fw = sys.stdout if output == '-' else open(output, 'w')
+        fw.write(f'Celltype\t' + '\t'.join(header + [f'{k}_{x}' for x in args.adjust for k in header]) + '\n')
+        for i, celltype in enumerate(celltypes):
+            fw.write(f'{celltype}')
+            for v in np.concatenate([x[i] for x in columns]).tolist():
+                fw.write(f'\t{v}')
+            fw.write('\n')
+        if fw is not sys.stdout:
+            fw.close()
+
     print('Done!')
 
 if __name__ == '__main__':
@@ -2,62 +2,55 @@
 
 import argparse
 import sys
-from collections import defaultdict
+from genomeUtils import open_input
+from rNMPUtils import read_table, read_matrix, normalize_rows, write_rows, read_batch
 
 
 def main():
     # argparse
     parser = argparse.ArgumentParser(description='Normalization of rNMP preference analysis')
-    parser.add_argument('raw', type=argparse.FileType('r'), help='rNMP incorporation file for desired chromosome.')
-    parser.add_argument('bg', type=argparse.FileType('r'), help='Background frequency')
-    parser.add_argument('-o', type=argparse.FileType('w'), default=sys.stdout, help='Output to file.')
-    parser.add_argument('--group_len', default=0, type=int, choices=[0,4,16], help='Number of rows of which the sum is 1, [4,16,0]." + \
+    parser.add_argument('raw', nargs='?', help='rNMP incorporation file for desired chromosome, or <container>:<library><suffix> for a table in a binary container.')
+    parser.add_argument('bg', nargs='?', help='Background frequency')
+    parser.add_argument('-o', default='-', help='Output to file.')
+    parser.add_argument('--group_len', default=0, type=int, choices=[0] + [4**x for x in range(1, 10)], help='Number of rows of which the sum is 1, [4,16,...,4^9,0]. Kmer contexts are grouped by rNMP base with 4^(k-1)." + \
                         " if 0 is selected, the sum of all rows would be 1. default = 0')
     parser.add_argument('--name', default='saccer', help='Name of chromosome in background frequency used for normalization, default = saccer')
+    parser.add_argument('--batch', type=argparse.FileType('r'), help='Tab separated file with raw file, background file, output file and optionally chromosome name in each line. Each background file is loaded once')
     args = parser.parse_args()
 
-    name = args.bg.readline().rstrip('\n').split()[1:]
-
-    # bg[species][di/tri] = freq
-    bg = defaultdict(dict)
-    for l in args.bg:
-        ws = l.rstrip('\n').split()
-        for i in range(1,len(ws)):
-            bg[ws[0]][name[i-1]] = float(ws[i])
-
-    # header
-    l = args.raw.readline()
-    args.o.write(l)
-    di = l.rstrip('\n').split('\t')
-
-    # normalize
-    for l in args.raw:
-        ws = l.split('\t')
-        if len(ws) != len(di):
-            continue
-        # normalize freq
-        freq = []
-        sp = args.name
-        assert sp in bg, f'[ERROR] Cannot find chrom {sp} in background file'
-        for i in range(1, len(ws)):
-            if bg[sp][di[i]] == 0:
-                freq.append(0)
-            else:
-                freq.append(float(ws[i])/bg[sp][di[i]])
-        # sum to 1
-        s = []
-        if args.group_len == 0:
-            group_len = len(freq)
-        else:
-            group_len = args.group_len
-        for i in range(int(len(freq)/group_len)):
-            s += [sum(freq[i*group_len:i*group_len+group_len])]*group_len
-        # prevent 0
-        for i in range(len(s)):
-            if s[i] == 0:
-                s[i] = 2**32
-        args.o.write(ws[0] + '\t' + '\t'.join([str(freq[i]/s[i]) for i in range(len(freq))]) + '\n')
-
+    # jobs of (raw, bg, output, chrom)
+    if args.batch:
+        jobs = [(x[0], x[1], x[2], x[3] if len(x) > 3 else args.name) for x in read_batch(args.batch)]
+    elif args.raw and args.bg:
+        jobs = [(args.raw, args.bg, args.o, args.name)]
+    else:
+        parser.error('raw and bg are required without --batch')
+
+    # bgs[file] = (kmers, {chrom: freq})
+    bgs = {}
+    for raw, bg, output, sp in jobs:
+        if bg not in bgs:
+            with open_input(bg) as fr:
+                _, kmers, names, freqs = read_matrix(fr, None)
+            bgs[bg] = (kmers, dict(zip(names, freqs)))
+        kmers, freqs = bgs[bg]
+        if sp not in freqs:
+            sys.exit(f'[ERROR] Cannot find chrom {sp} in background file')
+
+        # normalize all rows
+        header, di, names, counts = read_table(raw)
+        try:
+            index = {x:i for i, x in enumerate(kmers)}
+            freq = freqs[sp][[index[x] for x in di]]
+        except KeyError:
+            sys.exit(f'[ERROR] Cannot find all columns of {raw} in background file {bg}')
+        values = normalize_rows(counts, freq, args.group_len)
+
+        # output
+        fw = sys.stdout if output == '-' else open(output, 'w')
+        write_rows(fw, header, names, values)
+        if fw is not sys.stdout:
+            fw.close()
 
     print('Done!')
 
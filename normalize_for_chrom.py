@@ -2,66 +2,57 @@
 
 import argparse
 import sys
-
-# load bg
-def load_bg(fr):
-    fea = fr.readline().rstrip('\n').split('\t')
-    bg = {}
-    for l in fr:
-        ws =l.rstrip('\n').split('\t')
-        if len(ws) > 1:
-            bg[ws[0]] = {}
-            for i in range(1, len(ws)):
-                bg[ws[0]][fea[i]] = float(ws[i])
-    return bg
+from genomeUtils import open_input
+from rNMPUtils import read_table, read_matrix, normalize_rows, write_rows, read_batch
 
 
 def main():
     # argparse
     parser = argparse.ArgumentParser(description='Normalization of rNMP preference analysis')
-    parser.add_argument('raw', type=argparse.FileType('r'), help='rNMP incorporation file for desired chromosome.')
-    parser.add_argument('bg', type=argparse.FileType('r'), help='Background frequency')
-    parser.add_argument('-o', type=argparse.FileType('w'), default=sys.stdout, help='Output to file.')
-    parser.add_argument('--group_len', default=0, type=int, choices=[0,4,16], help='Number of rows of which the sum is 1, [4,16,0]." + \
+    parser.add_argument('raw', nargs='?', help='rNMP incorporation file for desired chromosome, or <container>:<library><suffix> for a table in a binary container.')
+    parser.add_argument('bg', nargs='?', help='Background frequency')
+    parser.add_argument('-o', default='-', help='Output to file.')
+    parser.add_argument('--group_len', default=0, type=int, choices=[0] + [4**x for x in range(1, 10)], help='Number of rows of which the sum is 1, [4,16,...,4^9,0]. Kmer contexts are grouped by rNMP base with 4^(k-1)." + \
                         " if 0 is selected, the sum of all rows would be 1. default = 0')
+    parser.add_argument('--batch', type=argparse.FileType('r'), help='Tab separated file with raw file, background file and output file in each line. Each background file is loaded once')
     args = parser.parse_args()
 
-    # load bg
-    bg = load_bg(args.bg)
-
-    # header
-    l = args.raw.readline()
-    args.o.write(l)
-    fea = l.rstrip('\n').split('\t')
-
-    # normalize
-    for l in args.raw:
-        ws = l.split('\t')
-        if len(ws) != len(fea):
-            continue
-        # normalize freq
-        freq = []
-        sp = ws[0]
+    # jobs of (raw, bg, output)
+    if args.batch:
+        jobs = [x[:3] for x in read_batch(args.batch)]
+    elif args.raw and args.bg:
+        jobs = [(args.raw, args.bg, args.o)]
+    else:
+        parser.error('raw and bg are required without --batch')
+
+    # bgs[file] = (kmers, chroms, freqs)
+    bgs = {}
+    for raw, bg, output in jobs:
+        if bg not in bgs:
+            with open_input(bg) as fr:
+                _, kmers, names, freqs = read_matrix(fr)
+            bgs[bg] = (kmers, {x:i for i, x in enumerate(names)}, freqs)
+        kmers, chroms, freqs = bgs[bg]
+
+        # normalize each row by the background of its chromosome
+        header, fea, names, counts = read_table(raw)
+        for sp in names:
+            if sp not in chroms:
+                sys.exit('[ERROR] Cannot find chrom {} in background file'.format(sp))
         try:
-            for i in range(1, len(ws)):
-                freq.append(float(ws[i])/bg[sp][fea[i]])
+            index = {x:i for i, x in enumerate(kmers)}
+            freq = freqs[[chroms[x] for x in names]][:, [index[x] for x in fea]]
         except KeyError:
-            sys.exit('[ERROR] Cannot find chrom {} in background file'.format(sp))
-        # sum to 1
-        s = []
-        if args.group_len == 0:
-            group_len = len(freq)
-        else:
-            group_len = args.group_len
-        for i in range(int(len(freq)/group_len)):
-            s += [sum(freq[i*group_len:i*group_len+group_len])]*group_len
-        # prevent 0
-        for i in range(len(s)):
-            if s[i] == 0:
-                s[i] = 2**32
-        args.o.write(ws[0] + '\t' + '\t'.join([str(freq[i]/s[i]) for i in range(len(freq))]) + '\n')
+            sys.exit(f'[ERROR] Cannot find all columns of {raw} in background file {bg}')
+        values = normalize_rows(counts, freq, args.group_len)
+
+        # output
+        fw = sys.stdout if output == '-' else open(output, 'w')
+        write_rows(fw, header, names, values)
+        if fw is not sys.stdout:
+            fw.close()
     print ('Done!')
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
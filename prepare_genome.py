@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+
+import argparse
+from genomeUtils import write_2bit
+
+def main():
+    # argparse
+    parser = argparse.ArgumentParser(description='Prepare a 2-bit packed genome (UCSC .2bit) used by count_background.py and count_rNMP.py')
+    parser.add_argument('FASTA', help='Reference genome FASTA')
+    parser.add_argument('-o', help='Output .2bit file, default = <FASTA>.2bit, which is found automatically by the counting tools')
+    args = parser.parse_args()
+
+    if not args.o:
+        args.o = args.FASTA + '.2bit'
+    write_2bit(args.FASTA, args.o)
+    print('Done! Genome is saved to {}!'.format(args.o))
+
+
+if __name__ == '__main__':
+    main()
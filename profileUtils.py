@@ -0,0 +1,95 @@
+from contextlib import contextmanager
+import json
+import sys
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# peak resident memory of this process in MB, None if it is unknown
+def peak_rss():
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+# opt-in instrumentation of stages, nothing is recorded until enable() is called
+# records go to stderr as text or to a file as JSON lines, progress always goes to stderr
+class Profiler:
+    def __init__(self):
+        self.fw = None
+        self.reading = None
+        self.last = 0
+        self.shown = False
+
+    def enable(self, path='-'):
+        self.fw = sys.stderr if path == '-' else open(path, 'w')
+
+    @property
+    def enabled(self):
+        return self.fw is not None
+
+    # write a record of a finished stage
+    def record(self, stage, wall, cpu, **fields):
+        if self.fw is None:
+            return
+        rec = {'stage':stage, 'wall':wall, 'cpu':cpu}
+        rec.update(fields)
+        rec.setdefault('peak_rss_mb', peak_rss())
+        if self.fw is sys.stderr:
+            self.clear_progress()
+            text = ' '.join(f'{k}={v:.3f}' if isinstance(v, float) else f'{k}={v}' for k, v in rec.items() if k != 'stage')
+            print(f'[PROFILE] {stage} {text}', file=self.fw)
+        else:
+            self.fw.write(json.dumps(rec) + '\n')
+            self.fw.flush()
+
+    # time a stage, fields can be added to the yielded dict inside the block
+    @contextmanager
+    def stage(self, stage, **fields):
+        wall, cpu = time.perf_counter(), time.process_time()
+        yield fields
+        self.record(stage, time.perf_counter() - wall, time.process_time() - cpu, **fields)
+
+    # progress and ETA of reading a file at byte offset of total bytes, shown at most once a second
+    def progress(self, name, offset, total):
+        if self.fw is None or not total:
+            return
+        now = time.perf_counter()
+        if self.reading is None or self.reading[0] != name:
+            self.reading = (name, now, offset)
+            self.last = now
+        if now - self.last < 1 and offset < total:
+            return
+        self.last = now
+        _, start, first = self.reading
+        rate = (offset - first) / (now - start) if now > start else 0
+        eta = f'{(total - offset) / rate:.0f}s' if rate > 0 else '-'
+        print(f'\r[PROGRESS] {name} {offset / total:.1%} {offset / 2**20:.1f}/{total / 2**20:.1f} MB ETA {eta}', end='', file=sys.stderr, flush=True)
+        self.shown = True
+
+    # end the progress line before other messages
+    def clear_progress(self):
+        if self.shown:
+            print(file=sys.stderr)
+            self.shown = False
+
+    def close(self):
+        self.clear_progress()
+        if self.fw is not None and self.fw is not sys.stderr:
+            self.fw.close()
+        self.fw = None
+
+
+# call func(task) and return its result with wall time, CPU time and peak memory, used in worker processes
+def timed_call(func, task):
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = func(task)
+    return result, {'wall':time.perf_counter() - wall, 'cpu':time.process_time() - cpu, 'peak_rss_mb':peak_rss()}
+
+
+# profiler shared by the counting scripts
+PROFILER = Profiler()
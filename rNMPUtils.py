@@ -1,46 +1,183 @@
-from collections import defaultdict
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import itertools as it
+import json
 import os
+import struct
+import sys
+import tempfile
+import time
+import zipfile
+import numpy as np
+from genomeUtils import read_chroms, kmer_list, indexed_chroms, fetch_codes, open_input, input_offset, input_file
+from profileUtils import PROFILER, timed_call
 
-# complement
-def rc(s):
-    c = {'A':'T', 'C':'G', 'G':'C', 'T':'A', 'N':'N'}
-    r = ''
-    for i in s:
-        if i not in c:
-            return ''
-        r = c[i] + r
-    return r
+# offsets of bases from the rNMP in each kmer
+OFFSETS = {'mono':(0,), 'nnr':(-2, -1, 0), 'nrn':(-1, 0, 1), 'rnn':(0, 1, 2)}
 
+# parse bed lines to chromosome ids, keys (position * 2 + minus strand) and counts
+# new chromosomes are added to crs
+def parse_bed(lines, use_frequency, crs):
+    chrom, pos, minus, count = [], [], [], []
+    for l in lines:
+        ws = l.rstrip('\n').split('\t')
+        if len(ws) < 6:
+            continue
+        chrom.append(crs.setdefault(ws[0], len(crs)))
+        pos.append(int(ws[2]))
+        minus.append(ws[5] == '-')
+        count.append(float(ws[3]) if use_frequency else 1)
+    return np.array(chrom, dtype=np.int64), np.array(pos, dtype=np.int64) * 2 + np.array(minus, dtype=bool), np.array(count, dtype=float)
 
-# get all positions
+
+# split parsed entries to chromosomes, yield (chrom id, index of its entries in input order)
+def split_chrom(chrom, nchrom):
+    order = np.argsort(chrom, kind='stable')
+    bounds = np.cumsum(np.bincount(chrom, minlength=nchrom))
+    for i in range(nchrom):
+        if bounds[i] > (bounds[i-1] if i else 0):
+            yield i, order[(bounds[i-1] if i else 0):bounds[i]]
+
+
+# reduce entries of one chromosome to [pos, minus, row, lib, count]
+def reduce_ribo(key, lib, count, nlib):
+    # sum up each position of each library in input order
+    pair, inv = np.unique(key * nlib + lib, return_inverse=True)
+    count = np.bincount(inv, weights=count)
+    key, lib = pair // nlib, pair % nlib
+    key, row = np.unique(key, return_inverse=True)
+    return [key // 2, key % 2 == 1, row, lib, count]
+
+
+# BED file of a library, paths are opened one at a time and closed after reading, file objects are used as they are
+@contextmanager
+def open_bed(bed):
+    if not isinstance(bed, str):
+        yield bed
+        return
+    fr = open_input(bed)
+    try:
+        yield fr
+    finally:
+        if bed != '-':
+            fr.close()
+
+
+# get all positions of BED files or paths
+# ribos[chrom] = [pos, minus, row, lib, count], sorted unique positions with strands
+# and counts of each library in coordinate form, (row, lib) pairs are unique
 def get_ribo_position(frs, use_frequency):
     libs = []
-    pos = defaultdict(lambda : [0]*len(frs))
+    entries = defaultdict(list)
     for fridx in range(len(frs)):
-        fr = frs[fridx]
-        libs.append(fr.name.split('/')[-1].split('.')[0])
-        for l in fr:
-            ws = l.rstrip('\n').split('\t')
-            if len(ws) < 6:
-                continue
-            if use_frequency:
-                pos[(ws[0], int(ws[2]), ws[5])][fridx] += float(ws[3])
-            else:
-                pos[(ws[0], int(ws[2]), ws[5])][fridx] += 1
+        with open_bed(frs[fridx]) as fr:
+            libs.append(fr.name.split('/')[-1].split('.')[0])
+            crs = {}
+            with PROFILER.stage('parse_bed', library=libs[-1]) as rec:
+                chrom, key, count = parse_bed(fr, use_frequency, crs)
+                rec['rows'] = len(chrom)
+                if PROFILER.enabled:
+                    rec['bytes'] = input_offset(getattr(fr, 'buffer', None))
+        names = list(crs)
+        for i, m in split_chrom(chrom, len(crs)):
+            entries[names[i]].append([key[m], np.full(len(m), fridx), count[m]])
 
-    results = defaultdict(list)
-    for k in sorted(pos.keys()):
-        results[k[0]].append([k[1], k[2], pos[k]])
-        del pos[k]
+    # reduce to unique positions
+    results = {}
+    with PROFILER.stage('reduce_ribo') as rec:
+        for cr in sorted(entries.keys()):
+            results[cr] = reduce_ribo(*[np.concatenate(x) for x in zip(*entries.pop(cr))], len(frs))
+        rec['positions'] = sum(len(x[0]) for x in results.values())
     return libs, results
 
 
-# read genome and count
-def get_ribo(ribos, libs, gr, mono, dinuc, trinuc, dist):
-    # initial output
+# get all positions like get_ribo_position with bounded memory
+# bed files are read by chunks, entries are sorted and spilled to temporary files once they exceed memory bytes
+def get_ribo_position_stream(frs, use_frequency, memory, tmpdir=None):
+    # parsing takes about 256 bytes per line
+    chunk_lines = int(min(max(memory // 256, 1024), 1<<20))
+    libs = []
+    crs = {}
+    runs = []
+    buf = defaultdict(list)
+    size = 0
+    tmp = tempfile.TemporaryDirectory(dir=tmpdir)
+    for fridx in range(len(frs)):
+        with open_bed(frs[fridx]) as fr:
+            libs.append(fr.name.split('/')[-1].split('.')[0])
+            wall, cpu, rows, spills = time.perf_counter(), time.process_time(), 0, len(runs)
+            while True:
+                lines = list(it.islice(fr, chunk_lines))
+                if not lines:
+                    break
+                chrom, key, count = parse_bed(lines, use_frequency, crs)
+                rows += len(chrom)
+                for i, m in split_chrom(chrom, len(crs)):
+                    buf[i].append([key[m], np.full(len(m), fridx, dtype=np.int32), count[m]])
+                size += len(chrom) * 20
+                # spill a sorted run
+                if size > memory:
+                    run = os.path.join(tmp.name, f'run{len(runs)}.npz')
+                    np.savez(run, **spill_run(buf))
+                    runs.append(run)
+                    buf = defaultdict(list)
+                    size = 0
+            if PROFILER.enabled:
+                PROFILER.record('parse_bed', time.perf_counter() - wall, time.process_time() - cpu, library=libs[-1], rows=rows, bytes=input_offset(getattr(fr, 'buffer', None)), spills=len(runs) - spills)
+    if buf:
+        runs.append(spill_run(buf))
+    return libs, SpilledRibos(tmp, runs, crs, len(frs))
+
+
+# entries of each chromosome sorted by position, input order is kept for the same position
+def spill_run(buf):
+    run = {}
+    for i, v in buf.items():
+        key, lib, count = [np.concatenate(x) for x in zip(*v)]
+        order = np.argsort(key, kind='stable')
+        run[f'{i}_key'], run[f'{i}_lib'], run[f'{i}_count'] = key[order], lib[order], count[order]
+    return run
+
+
+# rNMP positions in sorted runs, a chromosome is merged and reduced when it is accessed
+class SpilledRibos:
+    def __init__(self, tmp, runs, crs, nlib):
+        self.tmp = tmp
+        self.runs = runs
+        self.crs = dict(crs)
+        self.nlib = nlib
+
+    def __contains__(self, cr):
+        return cr in self.crs
+
+    def __len__(self):
+        return len(self.crs)
+
+    def __getitem__(self, cr):
+        i = self.crs[cr]
+        entries = []
+        for run in self.runs:
+            data = np.load(run) if isinstance(run, str) else run
+            if f'{i}_key' in data:
+                entries.append([data[f'{i}_key'], data[f'{i}_lib'].astype(np.int64), data[f'{i}_count']])
+        return reduce_ribo(*[np.concatenate(x) for x in zip(*entries)], self.nlib)
+
+    def __delitem__(self, cr):
+        del self.crs[cr]
+
+    def pop(self, cr):
+        ribo = self[cr]
+        del self[cr]
+        return ribo
+
+
+# initial output, dist_range = (min, max) distances of dinucleotide profiles
+# contexts = orientations of kmer contexts, like 'nnrnn' for pentanucleotides with the rNMP in the middle
+def init_result(mono, dinuc, trinuc, dist, dist_range=None, contexts=None):
     result = {}
     if mono:
-        # result['mono'][lib][chrom][A] = count
+        # result['mono'][chrom] = count matrix of libs x kmers
         result['mono'] = {}
     if dinuc:
         result['dinuc'] = {}
@@ -48,175 +185,523 @@ def get_ribo(ribos, libs, gr, mono, dinuc, trinuc, dist):
             result['dinuc'][i] = {'nr':{}, 'rn':{}}
     if trinuc:
         result['trinuc'] = {'nnr':{}, 'nrn':{}, 'rnn':{}}
-    # calculate cache length:
+    if dist_range:
+        # result['profile'][chrom] = count array of libs x (nr, rn) x distances x dinucleotides
+        result['profile'] = {}
+    if contexts:
+        result['kmer'] = {o:{} for o in contexts}
+    return result
+
+
+# read genome and count
+# names of all chromosomes are appended to chroms in genome order if it is given
+def get_ribo(ribos, libs, gr, mono, dinuc, trinuc, dist, chroms=None, dist_range=None, contexts=None):
+    result = init_result(mono, dinuc, trinuc, dist, dist_range, contexts)
+    def keep(cr):
+        if chroms is not None:
+            chroms.append(cr)
+        return cr in ribos
+    # read, only chromosomes with rNMPs are loaded
+    wall, cpu = time.perf_counter(), time.process_time()
+    for cr, genome in read_chroms(gr, keep):
+        PROFILER.record('read_chrom', time.perf_counter() - wall, time.process_time() - cpu, chrom=cr, bases=len(genome))
+        calc_chrom(cr, genome, ribos, libs, mono, dinuc, trinuc, dist, result, dist_range, contexts)
+        wall, cpu = time.perf_counter(), time.process_time()
+    return result
+
+
+# read genome and count with a process pool, long chromosomes are split to chunks
+# partial results are added up in the order of genome, so the output is deterministic
+def get_ribo_parallel(ribos, libs, gr, mono, dinuc, trinuc, dist, threads, chroms=None, dist_range=None, contexts=None, chunk_size=1<<26):
+    index = indexed_chroms(gr)
+    if index is None:
+        print('[WARNING] Reference genome cannot be indexed, count with one process!', file=sys.stderr)
+        return get_ribo(ribos, libs, gr, mono, dinuc, trinuc, dist, chroms, dist_range, contexts)
+    if chroms is not None:
+        chroms.extend(cr for cr, entry in index)
+    # bases needed around each chunk
     cache_len = 0
     if trinuc:
         cache_len = 2
     if dinuc:
         cache_len = max(dist+[cache_len])
-    # read
-    cr = None
-    genome = ''
-    for l in gr:
-        l = l.rstrip('\n')
-        # header
-        if l[0] == '>':
-            # calculate chromosome
-            calc_chrom(cr, genome, ribos, libs, mono, dinuc, trinuc, dist, result)
-            # initialize
-            cr = l[1:]
-            genome = ''
-        else:
-            genome += l.rstrip('\n').upper()
-    calc_chrom(cr, genome, ribos, libs, mono, dinuc, trinuc, dist, result)
+    if dist_range:
+        cache_len = max(dist_range[1], cache_len)
+    if contexts:
+        cache_len = max([len(o) - 1 for o in contexts] + [cache_len])
+    # tasks are made one chromosome at a time, so spilled positions are loaded only when they are needed
+    def split_tasks():
+        for cr, entry in index:
+            if cr not in ribos:
+                continue
+            pos, minus, row, lib, count = ribos.pop(cr)
+            for start in range(0, entry[1], chunk_size):
+                end = min(start + chunk_size, entry[1])
+                r0, r1 = np.searchsorted(pos, [start + 1, end + 1])
+                e0, e1 = np.searchsorted(row, [r0, r1])
+                ribo = [pos[r0:r1], minus[r0:r1], row[e0:e1] - r0, lib[e0:e1], count[e0:e1]]
+                yield (cr, gr, entry, start, end, cache_len, ribo, len(libs), mono, dinuc, trinuc, dist, dist_range, contexts)
+    # count and merge, at most two tasks for each process are in flight
+    result = init_result(mono, dinuc, trinuc, dist, dist_range, contexts)
+    running = deque()
+    def merge_first():
+        task, future = running.popleft()
+        part, stats = future.result()
+        merge_result(result, part)
+        PROFILER.record('count_chunk', chrom=task[0], start=task[3], end=task[4], positions=len(task[6][0]), rnmps=float(task[6][4].sum()), **stats)
+        print(f'{task[0]}:{task[3]}-{task[4]} finished! Length = {task[2][1]}')
+    with ProcessPoolExecutor(threads) as pool:
+        for task in split_tasks():
+            if len(running) >= 2 * threads:
+                merge_first()
+            running.append((task, pool.submit(timed_call, calc_chunk, task)))
+        while running:
+            merge_first()
     return result
 
 
-# calculate for chromosome
-def calc_chrom(cr, genome, ribos, libs, mono, dinuc, trinuc, dist, result):
+# count rNMPs of a chromosome chunk in [start, end) in a worker process
+def calc_chunk(task):
+    cr, gr, entry, start, end, cache_len, ribo, nlib, mono, dinuc, trinuc, dist, dist_range, contexts = task
+    result = init_result(mono, dinuc, trinuc, dist, dist_range, contexts)
+    if len(ribo[0]):
+        offset = max(start - cache_len, 0)
+        genome = fetch_codes(gr, entry, offset, min(end + cache_len, entry[1]))
+        count_ribo(cr, genome, ribo, nlib, mono, dinuc, trinuc, dist, result, offset, entry[1], dist_range, contexts)
+    return result
+
+
+# add partial result to result
+def merge_result(result, part):
+    for k, v in part.items():
+        if any(isinstance(x, dict) for x in v.values()):
+            merge_result(result[k], v)
+        else:
+            for cr, m in v.items():
+                result[k][cr] = result[k][cr] + m if cr in result[k] else m
+
+
+# calculate for chromosome, genome is 2-bit encoded
+def calc_chrom(cr, genome, ribos, libs, mono, dinuc, trinuc, dist, result, dist_range=None, contexts=None):
     if not cr:
         return
-    for pos, st, count in ribos[cr]:
-        if mono:
-            nuc = genome[pos-1]
-            if st == '-':
-                nuc = rc(nuc)
-            add_ribo(nuc, libs, count, cr, result['mono'])
-        if dinuc:
-            for d in dist:
-                if st == '+':
-                    # nr
-                    if pos - 1 - d >= 0:
-                        nuc = genome[pos-1-d] + genome[pos-1]
-                        add_ribo(nuc, libs, count, cr, result['dinuc'][d]['nr'])
-                    # rn
-                    if pos - 1 + d < len(genome):
-                        nuc = genome[pos-1] + genome[pos-1 + d]
-                        add_ribo(nuc, libs, count, cr, result['dinuc'][d]['rn'])
-                else:
-                    # nr
-                    if pos - 1 + d < len(genome):
-                        nuc = rc(genome[pos-1] + genome[pos-1+d])
-                        add_ribo(nuc, libs, count, cr, result['dinuc'][d]['nr'])
-                    # rn
-                    if pos - 1 - d >= 0:
-                        nuc = rc(genome[pos-1-d] + genome[pos-1])
-                        add_ribo(nuc, libs, count, cr, result['dinuc'][d]['rn'])
-        if trinuc:
-            if st == '+':
-                # nnr
-                if pos >=3:
-                    nuc = genome[pos-3:pos]
-                    add_ribo(nuc, libs, count, cr, result['trinuc']['nnr'])
-                # nrn
-                if 2<= pos <= len(genome) -1:
-                    nuc = genome[pos-2:pos +1]
-                    add_ribo(nuc, libs, count, cr, result['trinuc']['nrn'])
-                # rnn
-                if  pos <= len(genome) -2:
-                    nuc = genome[pos-1:pos +2]
-                    add_ribo(nuc, libs, count, cr, result['trinuc']['rnn'])
-            else:
-                # nnr
-                if  pos <= len(genome) -2:
-                    nuc = rc(genome[pos-1:pos +2])
-                    add_ribo(nuc, libs, count, cr, result['trinuc']['nnr'])
-                # nrn
-                if 2<= pos <= len(genome) -1:
-                    nuc = rc(genome[pos-2:pos +1])
-                    add_ribo(nuc, libs, count, cr, result['trinuc']['nrn'])
-                # rnn
-                if pos >=3:
-                    nuc = rc(genome[pos-3:pos])
-                    add_ribo(nuc, libs, count, cr, result['trinuc']['rnn'])
+    with PROFILER.stage('count_chrom', chrom=cr, bases=len(genome)) as rec:
+        ribo = ribos[cr]
+        count_ribo(cr, genome, ribo, len(libs), mono, dinuc, trinuc, dist, result, dist_range=dist_range, contexts=contexts)
+        rec['positions'], rec['rnmps'] = len(ribo[0]), float(ribo[4].sum())
     del ribos[cr]
     print(f'{cr} finished! Length = {len(genome)}')
 
 
-# add ribos for one entry
-def add_ribo(nuc, libs, counts, cr, result):
-    for i in range(len(counts)):
-        if libs[i] not in result:
-            result[libs[i]] = {}
-        if cr not in result[libs[i]]:
-            result[libs[i]][cr] = defaultdict(float)
-        if counts[i]:
-            result[libs[i]][cr][nuc] += counts[i]
+# count all modes for rNMPs of one chromosome
+# genome starts at offset of a chromosome with given length, the whole chromosome by default
+def count_ribo(cr, genome, ribo, nlib, mono, dinuc, trinuc, dist, result, offset=0, length=None, dist_range=None, contexts=None):
+    pos, minus, row, lib, count = ribo
+    pos = pos - 1
+    counts = (row, lib, count, nlib)
+    region = (offset, len(genome) if length is None else length)
+    if mono:
+        add_ribo(genome, pos, minus, counts, OFFSETS['mono'], cr, result['mono'], region)
+    if dinuc:
+        for d in dist:
+            add_ribo(genome, pos, minus, counts, (-d, 0), cr, result['dinuc'][d]['nr'], region)
+            add_ribo(genome, pos, minus, counts, (0, d), cr, result['dinuc'][d]['rn'], region)
+    if trinuc:
+        for o in ['nnr', 'nrn', 'rnn']:
+            add_ribo(genome, pos, minus, counts, OFFSETS[o], cr, result['trinuc'][o], region)
+    if dist_range:
+        add_profile(genome, pos, minus, counts, np.arange(dist_range[0], dist_range[1] + 1), cr, result['profile'], region)
+    if contexts:
+        for o in contexts:
+            add_ribo(genome, pos, minus, counts, context_offsets(o), cr, result['kmer'][o], region)
 
 
-# output
-def output(results, outputbase):
-    # build order
-    order = {'mono':[], 'nr':[], 'rn':[], 'nnr':[], 'nrn':[], 'rnn':[]}
-    base = ['A','C','G','T']
-    for i in base:
-        order['mono'].append(i)
-        for j in base:
-            order['nr'].append(j+i)
-            order['rn'].append(i+j)
-            for k in base:
-                order['nnr'].append(k+j+i)
-                order['nrn'].append(j+i+k)
-                order['rnn'].append(i+j+k)
-    # output
-    for k,v in results.items():
+# offsets of bases from the rNMP in a kmer context like 'nnrnn'
+def context_offsets(o):
+    r = o.index('r')
+    return tuple(range(-r, len(o) - r))
+
+
+# add ribos of one chromosome for all libraries, counts = (row, lib, count, number of libs)
+# region = (offset of genome in chromosome, chromosome length)
+# bases of kmer are taken at offsets from rNMP, offsets are reversed and complemented on minus strand
+def add_ribo(genome, pos, minus, counts, offsets, cr, result, region):
+    offset, length = region
+    if not len(genome):
+        return
+    idx = np.zeros(len(pos), dtype=np.intp)
+    inside = np.ones(len(pos), dtype=bool)
+    valid = np.ones(len(pos), dtype=bool)
+    sign = np.where(minus, -1, 1)
+    for o in offsets:
+        p = pos + sign * o
+        inside &= (p >= 0) & (p < length)
+        c = genome[np.clip(p - offset, 0, len(genome) - 1)].astype(np.intp)
+        valid &= c < 4
+        c[minus] = 3 - c[minus]
+        idx = idx * 4 + c
+    # the chromosome is reported once any rNMP has the whole kmer inside it
+    if not inside.any():
+        return
+    valid &= inside
+    # accumulate all libraries at once
+    row, lib, count, nlib = counts
+    n = 4 ** len(offsets)
+    m = valid[row]
+    result[cr] = np.bincount(lib[m] * n + idx[row[m]], weights=count[m], minlength=nlib * n).reshape(nlib, n).astype(float)
+
+
+# add nr and rn dinucleotides of all distances for ribos of one chromosome, like add_ribo
+# distances are gathered in blocks of a (rNMP, distance) matrix of about block_size bases
+def add_profile(genome, pos, minus, counts, dists, cr, result, region, block_size=1<<22):
+    offset, length = region
+    row, lib, count, nlib = counts
+    if not len(genome) or not len(pos):
+        return
+    sign = np.where(minus, -1, 1)[:, None]
+    # base of rNMP
+    r = genome[np.clip(pos - offset, 0, len(genome) - 1)].astype(np.intp)
+    valid_r = (r < 4) & (pos >= 0) & (pos < length)
+    r[minus] = 3 - r[minus]
+    r = r[:, None]
+    profile = np.zeros(nlib * 2 * len(dists) * 16)
+    step = max(block_size // len(row), 1)
+    for b in range(0, len(dists), step):
+        d = dists[b:b+step]
+        for o in range(2):
+            # neighbor at -d for nr and at +d for rn
+            p = pos[:, None] + sign * (d if o else -d)
+            c = genome[np.clip(p - offset, 0, len(genome) - 1)].astype(np.intp)
+            valid = (p >= 0) & (p < length) & (c < 4) & valid_r[:, None]
+            c[minus] = 3 - c[minus]
+            idx = r * 4 + c if o else c * 4 + r
+            # flat index of (lib, orientation, distance, dinucleotide) for each entry and distance
+            idx += ((o * len(dists) + b + np.arange(len(d))) * 16)
+            m = valid[row]
+            key = (lib[:, None] * (2 * len(dists) * 16) + idx[row])[m]
+            profile += np.bincount(key, weights=np.broadcast_to(count[:, None], m.shape)[m], minlength=len(profile))
+    profile = profile.reshape(nlib, 2, len(dists), 16)
+    result[cr] = result[cr] + profile if cr in result else profile
+
+
+# kmers of an orientation in output order, sorted by the rNMP base and then by bases nearer to the rNMP
+def output_order(o):
+    if o == 'mono':
+        o = 'r'
+    r = o.index('r')
+    keys = sorted(range(len(o)), key=lambda i: (abs(i - r), i))
+    return sorted(kmer_list(len(o)), key=lambda x: [x[i] for i in keys])
+
+
+# tables of each mode as (file suffix, result[chrom] = count matrix of libs x kmers)
+def result_tables(results):
+    tables = []
+    for k, v in results.items():
         if k == 'mono':
-            for lib, v1 in v.items():
-                with open(generate_outputname(outputbase, lib) + '.mono', 'w') as fw:
-                    fw.write('\t'.join(['Sample'] + order['mono']) + '\n')
-                    for cr, v2 in v1.items():
-                        fw.write(cr + '\t' + '\t'.join(list(map(str, [v2[x] for x in order['mono']]))) + '\n')
+            tables.append(('.mono', v))
         if k == 'dinuc':
-            for d, v00 in v.items():
-                for o, v0 in v00.items():
-                    if o == 'nr':
-                        for lib, v1 in v0.items():
-                            with open(generate_outputname(outputbase, lib) +  f'.{k}_d{d}_nr', 'w') as fw:
-                                fw.write('\t'.join(['Sample'] + order['nr']) + '\n')
-                                for cr, v2 in v1.items():
-                                    fw.write(cr + '\t' + '\t'.join(list(map(str, [v2[x] for x in order['nr']]))) + '\n')
-                    else:
-                        for lib, v1 in v0.items():
-                            with open(generate_outputname(outputbase, lib) +  f'.{k}_d{d}_rn', 'w') as fw:
-                                fw.write('\t'.join(['Sample'] + order['rn']) + '\n')
-                                for cr, v2 in v1.items():
-                                    fw.write(cr + '\t' + '\t'.join(list(map(str, [v2[x] for x in order['rn']]))) + '\n')
+            for d, v0 in v.items():
+                for o in ['nr', 'rn']:
+                    tables.append((f'.{k}_d{d}_{o}', v0[o]))
         if k == 'trinuc':
             for o, v0 in v.items():
-                if o == 'nnr':
-                    for lib, v1 in v0.items():
-                        with open(generate_outputname(outputbase, lib) + '.trinuc_nnr', 'w') as fw:
-                            fw.write('\t'.join(['Sample'] + order['nnr']) + '\n')
-                            for cr, v2 in v1.items():
-                                fw.write(cr + '\t' + '\t'.join(list(map(str, [v2[x] for x in order['nnr']]))) + '\n')
-                elif o=='nrn':
-                    for lib, v1 in v0.items():
-                        with open(generate_outputname(outputbase, lib) + '.trinuc_nrn', 'w') as fw:
-                            fw.write('\t'.join(['Sample'] + order['nrn']) + '\n')
-                            for cr, v2 in v1.items():
-                                fw.write(cr + '\t' + '\t'.join(list(map(str, [v2[x] for x in order['nrn']]))) + '\n')
-                else:
-                    for lib, v1 in v0.items():
-                        with open(generate_outputname(outputbase, lib) + '.trinuc_rnn', 'w') as fw:
-                            fw.write('\t'.join(['Sample'] + order['rnn']) + '\n')
-                            for cr, v2 in v1.items():
-                                fw.write(cr + '\t' + '\t'.join(list(map(str, [v2[x] for x in order['rnn']]))) + '\n')
+                tables.append((f'.trinuc_{o}', v0))
+        if k == 'kmer':
+            for o, v0 in v.items():
+                tables.append((f'.k{len(o)}_{o}', v0))
+    return tables
 
 
-# generate output name
-def generate_outputname(outputbase, lib):
+# count tables of each library, libraries with the same name are merged
+# tables[name][suffix][chrom] = counts of kmers
+def library_tables(results, libs):
+    tables = {name:{} for name in dict.fromkeys(libs)}
+    for suffix, v in result_tables(results):
+        if not v:
+            continue
+        for name in tables:
+            rows = [i for i in range(len(libs)) if libs[i] == name]
+            tables[name][suffix] = {cr:v1[rows].sum(axis=0) for cr, v1 in v.items()}
+    return tables
+
+
+# write tables of a library, rows[suffix] = chromosomes of each table
+# chromosomes missing from the library are zeros
+def write_library(outputbase, name, tables, rows):
+    for suffix, crs in rows.items():
+        with open(generate_outputname(outputbase, name) + suffix, 'w') as fw:
+            write_table(fw, suffix, tables.get(suffix, {}), crs)
+
+
+# kmers of a table in output order and their columns in kmer_list order
+def output_columns(suffix):
+    kmers = output_order(suffix.split('_')[-1].lstrip('.'))
+    index = {x:i for i, x in enumerate(kmer_list(len(kmers[0])))}
+    return kmers, [index[x] for x in kmers]
+
+
+# write a count table, v[chrom] = counts of kmers in kmer_list order
+def write_table(fw, suffix, v, crs):
+    kmers, cols = output_columns(suffix)
+    fw.write('\t'.join(['Sample'] + kmers) + '\n')
+    for cr in crs:
+        counts = v[cr][cols] if cr in v else np.zeros(len(cols))
+        fw.write(cr + '\t' + '\t'.join(map(str, counts.tolist())) + '\n')
+
+
+# output
+def output(results, libs, outputbase):
+    rows = {suffix:list(v) for suffix, v in result_tables(results) if v}
+    for name, tables in library_tables(results, libs).items():
+        write_library(outputbase, name, tables, rows)
+
+
+# name of the binary container of a run
+def container_name(outputbase, name='counts'):
     if not outputbase:
-        return lib
+        return name + '.npz'
     if os.path.isdir(outputbase):
-        return outputbase + '/' + lib
-    return outputbase + '_' + lib
+        return os.path.join(outputbase, name + '.npz')
+    return f'{outputbase}.{name}.npz'
+
 
+# write dinucleotide profiles of a run to an npz file
+# counts: array of (library, chromosome, orientation, distance, dinucleotide), orientations are nr and rn
+# libraries, chromosomes, distances, dinucleotides: names of axes, chromosomes are in genome order
+def write_profile(path, profile, libs, chroms, dist_range):
+    names = list(dict.fromkeys(libs))
+    index = {}
+    for i, cr in enumerate(chroms):
+        index.setdefault(cr, i)
+    crs = sorted(profile, key=index.get)
+    dists = np.arange(dist_range[0], dist_range[1] + 1)
+    counts = np.zeros((len(names), len(crs), 2, len(dists), 16))
+    for j, cr in enumerate(crs):
+        for i, name in enumerate(names):
+            counts[i, j] = profile[cr][[x == name for x in libs]].sum(axis=0)
+    np.savez(path, counts=counts, libraries=np.array(names, dtype=str), chromosomes=np.array(crs, dtype=str),
+             orientations=np.array(['nr', 'rn']), distances=dists, dinucleotides=np.array(kmer_list(2), dtype=str))
+
+
+# write all tables of a run to a binary container, an uncompressed npz file
+# counts_k{k}: count tensor of (library, chromosome, table, kmer) for tables of kmer length k
+# tables_k{k}: names (file suffixes) of tables, kmers_k{k}: kmers in kmer_list order
+# present_k{k}: (table, chromosome), whether a chromosome is a row of a table
+# libraries, chromosomes: names of library and chromosome axes, chromosomes are in genome order
+def write_container(path, results, libs, chroms):
+    names = list(dict.fromkeys(libs))
+    rows = [[i for i in range(len(libs)) if libs[i] == name] for name in names]
+    tables = [(suffix, v) for suffix, v in result_tables(results) if v]
+    # chromosomes of any table in genome order
+    index = {}
+    for i, cr in enumerate(chroms):
+        index.setdefault(cr, i)
+    crs = sorted({cr for suffix, v in tables for cr in v}, key=index.get)
+    index = {cr:i for i, cr in enumerate(crs)}
+    arrays = {'libraries':np.array(names, dtype=str), 'chromosomes':np.array(crs, dtype=str)}
+    # tables of 4**k columns
+    for k in sorted({(next(iter(v.values())).shape[1].bit_length() - 1) // 2 for suffix, v in tables}):
+        group = [(suffix, v) for suffix, v in tables if next(iter(v.values())).shape[1] == 4 ** k]
+        counts = np.zeros((len(names), len(crs), len(group), 4 ** k))
+        present = np.zeros((len(group), len(crs)), dtype=bool)
+        for j, (suffix, v) in enumerate(group):
+            c = [index[cr] for cr in v]
+            present[j, c] = True
+            # libraries with the same name are merged
+            m = np.stack(list(v.values()))
+            for i in range(len(names)):
+                counts[i, c, j] = m[:, rows[i]].sum(axis=1)
+        arrays[f'counts_k{k}'] = counts
+        arrays[f'present_k{k}'] = present
+        arrays[f'tables_k{k}'] = np.array([suffix for suffix, v in group], dtype=str)
+        arrays[f'kmers_k{k}'] = np.array(kmer_list(k), dtype=str)
+    np.savez(path, **arrays)
+
+
+# read a binary container, numeric arrays are memory-mapped
+def load_container(path):
+    data = {}
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as fr:
+        for info in zf.infolist():
+            # array starts after the local file header with file name and extra field
+            fr.seek(info.header_offset + 26)
+            n, m = struct.unpack('<2H', fr.read(4))
+            fr.seek(info.header_offset + 30 + n + m)
+            version = np.lib.format.read_magic(fr)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(fr)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(fr)
+            key = info.filename[:-4]
+            if info.compress_type == zipfile.ZIP_STORED and dtype.kind in 'biuf' and all(shape):
+                data[key] = np.memmap(path, dtype, 'r', fr.tell(), shape, 'F' if fortran else 'C')
+            else:
+                with zf.open(info) as f:
+                    data[key] = np.load(f)
+    return data
 
 
+# count table of a library in a container, returned like read_matrix
+# (header line, column names, row names, values) with columns in the order of its TSV output
+def container_table(data, name, suffix):
+    libs = data['libraries'].tolist()
+    if name not in libs:
+        sys.exit(f'[ERROR] Cannot find library {name} in the container!')
+    for k in [x[len('tables_k'):] for x in data if x.startswith('tables_k')]:
+        if suffix in data[f'tables_k{k}'].tolist():
+            j = data[f'tables_k{k}'].tolist().index(suffix)
+            crs = data['chromosomes'][data[f'present_k{k}'][j]].tolist()
+            kmers, cols = output_columns(suffix)
+            counts = data[f'counts_k{k}'][libs.index(name), data[f'present_k{k}'][j], j][:, cols]
+            return '\t'.join(['Sample'] + kmers) + '\n', kmers, crs, counts
+    sys.exit(f'[ERROR] Cannot find table {suffix} in the container!')
 
 
+# container path and table name of <container>:<library><suffix>, None and the spec itself for other files
+def split_table_spec(spec):
+    path, _, name = spec.rpartition(':')
+    if path.endswith('.npz') and os.path.isfile(path):
+        return path, name
+    return None, spec
 
 
+# argparse type of a count table, either a file or a table in a container, it is read later with read_table
+def table_file(spec):
+    path, _ = split_table_spec(spec)
+    return spec if path is not None else input_file(spec)
 
 
+# read a count table like read_matrix, either a file or a table in a container as <container>:<library><suffix>
+# tables in a container are taken from its arrays without formatting them as text
+def read_table(spec):
+    path, name = split_table_spec(spec)
+    if path is None:
+        with open_input(spec) as fr:
+            return read_matrix(fr)
+    lib, _, suffix = name.partition('.')
+    return container_table(load_container(path), lib, '.' + suffix)
 
+
+# per-library result store in a directory
+# store.json keeps counting parameters, chromosomes of the genome and each table, and names of libraries
+# tables of each library are kept in <library>.npz
+def load_store(store):
+    path = os.path.join(store, 'store.json')
+    if not os.path.isfile(path):
+        return None
+    with open(path) as fr:
+        return json.load(fr)
+
+
+# tables of a library in the store
+def load_library(store, name):
+    tables = {}
+    with np.load(os.path.join(store, name + '.npz')) as data:
+        for key in data.files:
+            if not key.endswith('_chroms'):
+                tables['.' + key] = dict(zip(data[key + '_chroms'].tolist(), data[key]))
+    return tables
+
+
+# save tables of a library to the store
+def save_library(store, name, tables):
+    arrays = {}
+    for suffix, v in tables.items():
+        arrays[suffix[1:]] = np.array(list(v.values()))
+        arrays[suffix[1:] + '_chroms'] = np.array(list(v), dtype=str)
+    np.savez(os.path.join(store, name + '.npz'), **arrays)
+
+
+# add libraries to the store and write outputs, libraries already in the store are replaced
+# outputs of other libraries are only rewritten if chromosomes of any table change
+def update_store(store, tables, params, chroms, outputbase):
+    meta = load_store(store)
+    if meta is None:
+        os.makedirs(store, exist_ok=True)
+        meta = dict(params, chroms=chroms, rows={}, libs=[])
+    else:
+        for k, v in params.items():
+            if meta.get(k, []) != v:
+                sys.exit(f'[ERROR] Parameter {k} ({v}) does not match the store ({meta.get(k, [])})!')
+        if meta['chroms'] != chroms:
+            sys.exit('[ERROR] Chromosomes of the reference genome do not match the store!')
+    # chromosomes of each table in genome order, the first one of duplicated names is used
+    index = {}
+    for i, cr in enumerate(chroms):
+        index.setdefault(cr, i)
+    changed = False
+    for name, v in tables.items():
+        if name in meta['libs']:
+            print(f'[WARNING] Library {name} is replaced in the store!', file=sys.stderr)
+        else:
+            meta['libs'].append(name)
+        save_library(store, name, v)
+        for suffix, v0 in v.items():
+            rows = meta['rows'].setdefault(suffix, [])
+            new = [cr for cr in v0 if cr not in rows]
+            if new:
+                meta['rows'][suffix] = sorted(rows + new, key=index.get)
+                changed = True
+    path = os.path.join(store, 'store.json')
+    with open(path + '.tmp', 'w') as fw:
+        json.dump(meta, fw)
+    os.replace(path + '.tmp', path)
+    # output
+    for name in meta['libs'] if changed else tables:
+        write_library(outputbase, name, tables[name] if name in tables else load_library(store, name), meta['rows'])
+    return meta['libs']
+
+
+# read a frequency table, return header line, column names, row names and values
+# fields are split by sep, rows without a value of each column are skipped
+def read_matrix(fr, sep='\t'):
+    header = fr.readline()
+    cols = header.rstrip('\n').split(sep)
+    names, values = [], []
+    for l in fr:
+        ws = l.rstrip('\n').split(sep)
+        if len(ws) != len(cols):
+            continue
+        names.append(ws[0])
+        values.append(ws[1:])
+    return header, cols[1:], names, np.array(values, dtype=float).reshape(len(names), len(cols) - 1)
+
+
+# normalize rows of raw counts by background frequencies of the same shape, kmers with zero background are 0
+# each group of group_len columns sums to 1, all columns if group_len is 0, groups summing to 0 stay 0
+def normalize_rows(raw, bg, group_len):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        freq = np.where(bg == 0, 0, raw / np.where(bg == 0, 1, bg))
+    shape = freq.shape
+    n = group_len or shape[1] or 1
+    freq = freq.reshape(shape[0], shape[1] // n, n)
+    # sum up each group in column order
+    s = np.cumsum(freq, axis=2)[:, :, -1:]
+    s[s == 0] = 2**32
+    return (freq / s).reshape(shape)
+
+
+# write normalized rows after the header line of the raw table
+def write_rows(fw, header, names, values):
+    fw.write(header)
+    for name, v in zip(names, values.tolist()):
+        fw.write(name + '\t' + '\t'.join(map(str, v)) + '\n')
+
+
+# jobs of a batch file, each line is raw table, background, output and other fields
+def read_batch(fr):
+    jobs = []
+    for l in fr:
+        ws = l.rstrip('\n').split('\t')
+        if len(ws) >= 3 and not l.startswith('#'):
+            jobs.append(ws)
+    return jobs
+
+
+# generate output name
+def generate_outputname(outputbase, lib):
+    if not outputbase:
+        return lib
+    if os.path.isdir(outputbase):
+        return outputbase + '/' + lib
+    return outputbase + '_' + lib
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+from genomeUtils import *
+from rNMPUtils import generate_outputname
+
+
+# regions of a BED file as (chromosome index, start, end), chromosomes not in the genome are skipped
+def read_regions(fr, names):
+    regions = []
+    missing = set()
+    for l in fr:
+        ws = l.rstrip('\n').split('\t')
+        if len(ws) < 3 or l.startswith(('#', 'track', 'browser')):
+            continue
+        if ws[0] not in names:
+            missing.add(ws[0])
+            continue
+        regions.append((names[ws[0]], int(ws[1]), int(ws[2])))
+    for chrom in sorted(missing):
+        print(f'[WARNING] Chromosome {chrom} of {fr.name} is not in the genome, its regions are skipped!', file=sys.stderr)
+    return regions
+
+
+# add opposite strand and write background table, one row for each region set
+def write_table(fw, rows, k, single_strand):
+    rci = rc_index(k)
+    fw.write('Sample\t' + '\t'.join(kmer_list(k)) + '\n')
+    for name, counts in rows:
+        if not single_strand:
+            counts = counts + counts[rci]
+        fw.write(f'{name}\t' + '\t'.join(map(str, counts.tolist())) + '\n')
+
+
+def main():
+    # argument parser
+    parser = argparse.ArgumentParser(description='Count background frequency of genome regions from a prefix-sum index of kmers')
+    parser.add_argument('GENOME', help='Reference genome, an indexable FASTA or a .2bit file. The kmer index <GENOME>.kidx.npz is built on first use')
+    parser.add_argument('BED', type=input_file, nargs='*', help='BED files of regions, plain or gzip/bgzip compressed. Each file is a row of output named by the file name. Only the index is built without BED files')
+    parser.add_argument('-o', type=output_file, default='-', help='Output to file, default = stdout (\'-\'). Output basename if several tables are counted')
+    parser.add_argument('-s', action='store_true', help='Count only one strand')
+    parser.add_argument('--mono', action='store_true', help='Count mono nucleotide')
+    parser.add_argument('--dinuc', action='store_true', help='Count dinucleotide, default if no other mode is selected')
+    parser.add_argument('--trinuc', action='store_true', help='Count trinucleotide')
+    parser.add_argument('--stride', type=int, default=1<<14, help='Bases between prefix sums of the index, the index is built again if it changes, default = 16384')
+    args = parser.parse_args()
+
+    # tables to count, (suffix, k)
+    tables = []
+    if args.mono:
+        tables.append(('.mono', 1))
+    if args.dinuc or not (args.mono or args.trinuc):
+        tables.append(('.dinuc_d1', 2))
+    if args.trinuc:
+        tables.append(('.trinuc', 3))
+    if len(tables) > 1 and args.o == '-':
+        sys.exit('[ERROR] Output basename is needed to count several tables!')
+    if args.stride < 1:
+        sys.exit('[ERROR] Stride should be at least 1!')
+
+    # index
+    index = load_kmer_index(args.GENOME, args.stride)
+    if index is None:
+        sys.exit('[ERROR] Genome cannot be indexed, prepare it with prepare_genome.py!')
+    if not args.BED:
+        print('Done!')
+        return
+    # chromosomes are found by full header or the first word, the first one of duplicated names is used
+    names = {}
+    for i, chrom in enumerate(index['chromosomes'].tolist()):
+        names.setdefault(chrom, i)
+    for i, chrom in enumerate(index['chromosomes'].tolist()):
+        names.setdefault(chrom.split()[0] if chrom.split() else chrom, i)
+
+    # count
+    regions = []
+    for bed in args.BED:
+        with open_input(bed) as fr:
+            regions.append((bed.split('/')[-1].split('.')[0], read_regions(fr, names)))
+    results = [[(name, query_kmer_index(args.GENOME, index, x, k)) for name, x in regions] for _, k in tables]
+
+    # output, one table to file or stdout, several tables are named like count_background.py
+    if len(tables) == 1:
+        fw = sys.stdout if args.o == '-' else open(args.o, 'w')
+        write_table(fw, results[0], tables[0][1], args.s)
+        if fw is not sys.stdout:
+            fw.close()
+    else:
+        name = args.GENOME.split('/')[-1].split('.')[0]
+        for (suffix, k), rows in zip(tables, results):
+            with open(generate_outputname(args.o, name) + suffix, 'w') as fw:
+                write_table(fw, rows, k, args.s)
+    print('Done!')
+
+if __name__ == '__main__':
+    main()
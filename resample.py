@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import argparse
+import itertools as it
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from genomeUtils import input_file, open_input
+from rNMPUtils import table_file, read_table, read_matrix, normalize_rows
+
+
+# group of each library, library name without the last field
+def get_groups(names, connector):
+    groups = {}
+    for i, name in enumerate(names):
+        groups.setdefault(name.rsplit(connector, 1)[0], []).append(i)
+    return {k:np.array(v) for k, v in groups.items()}
+
+
+# bootstrap replicates of group means of normalized frequencies
+# libraries of each group are resampled with replacement, then rNMP counts of each library from a multinomial distribution
+def bootstrap_chunk(task):
+    seed, n, counts, bg, group_len, groups = task
+    rng = np.random.default_rng(seed)
+    total = counts.sum(axis=1)
+    p = counts / np.where(total == 0, 1, total)[:, None]
+    p[total == 0] = 1 / counts.shape[1]
+    total = np.rint(total).astype(np.int64)
+    result = np.empty((len(groups), n, counts.shape[1]))
+    for g, idx in enumerate(groups):
+        pick = idx[rng.integers(0, len(idx), size=(n, len(idx)))]
+        draws = rng.multinomial(total[pick], p[pick]).reshape(-1, counts.shape[1])
+        result[g] = normalize_rows(draws.astype(float), bg, group_len).reshape(n, len(idx), -1).mean(axis=1)
+    return result
+
+
+# number of label permutations with a difference of group means at least as large as observed
+# the first n1 libraries are the first group
+def permutation_chunk(task):
+    seed, n, freq, n1, observed = task
+    rng = np.random.default_rng(seed)
+    perm = rng.permuted(np.tile(np.arange(len(freq)), (n, 1)), axis=1)
+    x = freq[perm]
+    diff = x[:, :n1].mean(axis=1) - x[:, n1:].mean(axis=1)
+    return np.count_nonzero(np.abs(diff) >= np.abs(observed) * (1 - 1e-12), axis=0)
+
+
+# split replicates to chunks with independent random streams, results do not depend on the number of processes
+def chunk_seeds(seed, replicates, chunk_size):
+    sizes = [min(chunk_size, replicates - i) for i in range(0, replicates, chunk_size)]
+    return zip(np.random.SeedSequence(seed).spawn(len(sizes)), sizes)
+
+
+def main():
+    # argparse
+    parser = argparse.ArgumentParser(description='Bootstrap confidence intervals and permutation tests of normalized rNMP incorporation frequency')
+    parser.add_argument('raw', type=table_file, help='rNMP incorporation counts of libraries, e.g. output of get_chrom.py')
+    parser.add_argument('bg', type=input_file, help='Background frequency')
+    parser.add_argument('-o', type=argparse.FileType('w'), default=sys.stdout, help='Output to file')
+    parser.add_argument('--group_len', default=0, type=int, choices=[0] + [4**x for x in range(1, 10)], help='Number of rows of which the sum is 1, [4,16,...,4^9,0]. Kmer contexts are grouped by rNMP base with 4^(k-1). If 0 is selected, the sum of all rows would be 1. default = 0')
+    parser.add_argument('--name', default='saccer', help='Name of chromosome in background frequency used for normalization, default = saccer')
+    parser.add_argument('-d', default='-', help='Connector of library informations, libraries are grouped by names without the last field, default = \'-\'')
+    parser.add_argument('--bootstrap', type=int, default=10000, help='Number of bootstrap replicates, default = 10000')
+    parser.add_argument('--permutation', type=int, default=10000, help='Number of permutations for each pair of groups, default = 10000')
+    parser.add_argument('--ci', type=float, default=95, help='Confidence level of intervals in percent, default = 95')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed, default = 0')
+    parser.add_argument('-p', '--threads', default=1, type=int, help='Number of processes, default = 1')
+    args = parser.parse_args()
+
+    # load counts and background
+    header, kmers, names, counts = read_table(args.raw)
+    with open_input(args.bg) as fr:
+        _, bg_kmers, bg_names, bg_freqs = read_matrix(fr, None)
+    if args.name not in bg_names:
+        sys.exit(f'[ERROR] Cannot find chrom {args.name} in background file')
+    try:
+        index = {x:i for i, x in enumerate(bg_kmers)}
+        bg = bg_freqs[bg_names.index(args.name)][[index[x] for x in kmers]]
+    except KeyError:
+        sys.exit('[ERROR] Cannot find all columns of raw file in background file')
+    groups = get_groups(names, args.d)
+    freq = normalize_rows(counts, bg, args.group_len)
+    print(f'{len(names)} libraries in {len(groups)} groups!', file=sys.stderr)
+
+    # tasks of replicate chunks, permutations of each pair of groups
+    chunk_size = 100
+    boot_tasks = [(seed, n, counts, bg, args.group_len, list(groups.values())) for seed, n in chunk_seeds([args.seed, 0], args.bootstrap, chunk_size)]
+    pairs = list(it.combinations(groups, 2))
+    perm_tasks = []
+    for i, (g1, g2) in enumerate(pairs):
+        observed = freq[groups[g1]].mean(axis=0) - freq[groups[g2]].mean(axis=0)
+        f = freq[np.concatenate([groups[g1], groups[g2]])]
+        perm_tasks.append([(seed, n, f, len(groups[g1]), observed) for seed, n in chunk_seeds([args.seed, 1, i], args.permutation, chunk_size)])
+
+    # resample
+    if args.threads > 1:
+        with ProcessPoolExecutor(args.threads) as pool:
+            boot = list(pool.map(bootstrap_chunk, boot_tasks))
+            perm = [pool.map(permutation_chunk, x) for x in perm_tasks]
+            exceed = [sum(x, np.zeros(len(kmers))) for x in perm]
+    else:
+        boot = list(map(bootstrap_chunk, boot_tasks))
+        exceed = [sum(map(permutation_chunk, x), np.zeros(len(kmers))) for x in perm_tasks]
+
+    # output
+    alpha = (100 - args.ci) / 2
+    args.o.write('\t'.join(['Sample'] + kmers) + '\n')
+    for g, (k, idx) in enumerate(groups.items()):
+        rows = [(k, freq[idx].mean(axis=0))]
+        if boot:
+            low, high = np.percentile(np.concatenate([x[g] for x in boot]), [alpha, 100 - alpha], axis=0)
+            rows += [(f'{k}_low', low), (f'{k}_high', high)]
+        for name, v in rows:
+            args.o.write(name + '\t' + '\t'.join(map(str, v.tolist())) + '\n')
+    for (g1, g2), count in zip(pairs, exceed):
+        p = (count + 1) / (args.permutation + 1)
+        args.o.write(f'{g1}_vs_{g2}_p\t' + '\t'.join(map(str, p.tolist())) + '\n')
+
+    print('Done!')
+
+
+if __name__ == '__main__':
+    main()